@@ -0,0 +1,134 @@
+# Times the construction and serialization of synthetic documents (see
+# synthetic.py) and measures the peak memory of every phase. Each phase
+# runs in a fresh process, so the peaks do not leak into each other.
+#
+#   python benchmarks/bench_documents.py --contexts 200 --anchors 5000
+#
+# Peak Python heap comes from tracemalloc; lxml allocates outside of it, so
+# the growth of the maximum resident set size is reported as well.
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+
+
+# Keyword arguments of dump and dump_file selecting each serializer
+BACKENDS = {'tree': {},
+            'streaming': {'streaming': True},
+            'text': {'text': True},
+            'incremental': {'incremental': True},
+            'compact': {'compact': True},
+            'gzip': {'compact': True, 'compress': True}}
+
+
+def phase_build(ncldoc, shape, backend):
+    synthetic.build_document(**shape)
+
+
+def phase_to_xml(ncldoc, shape, backend):
+    ncldoc._NclDocument__to_xml()
+
+
+def phase_dump(ncldoc, shape, backend):
+    ncldoc.dump(**BACKENDS[backend])
+
+
+def phase_dump_file(ncldoc, shape, backend):
+    handle, filename = tempfile.mkstemp(suffix='.ncl')
+    os.close(handle)
+    try:
+        ncldoc.dump_file(filename, **BACKENDS[backend])
+    finally:
+        os.remove(filename)
+
+
+PHASES = [('build', phase_build, False),
+          ('to_xml', phase_to_xml, False),
+          ('dump', phase_dump, True),
+          ('dump_file', phase_dump_file, True)]
+
+
+def run_phase(phase, shape, backend, repeat):
+    # Runs in a child process. The timed runs come first and untraced, the
+    # resident set growth is taken over the first of them and the heap peak
+    # over one more run under tracemalloc, which slows everything down.
+    function = dict((name, function) for name, function, _ in PHASES)[phase]
+    ncldoc = None
+    if phase != 'build':
+        ncldoc = synthetic.build_document(**shape)
+    
+    try:
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            function(ncldoc, shape, backend)
+            timings.append(time.perf_counter() - started)
+            if len(timings) == 1:
+                rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        
+        tracemalloc.start()
+        try:
+            function(ncldoc, shape, backend)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    except Exception as error:
+        return {'error': '%s: %s' % (type(error).__name__, error)}
+    return {'first': timings[0], 'best': min(timings), 'heap_peak': peak, 
+            'rss_growth': (rss_after - rss_before) * 1024}
+
+
+def isolated(phase, shape, backend, repeat):
+    with ProcessPoolExecutor(1) as executor:
+        return executor.submit(run_phase, phase, shape, backend, repeat).result()
+
+
+def megabytes(size):
+    return '%.1f' % (size / (1024.0 * 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pyncl on synthetic documents')
+    for name, default in synthetic.DEFAULTS.items():
+        parser.add_argument('--' + name, type=int, default=default)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs, the best is shown')
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        help='comma separated subset of ' + ', '.join(BACKENDS))
+    args = parser.parse_args()
+    
+    shape = dict((name, getattr(args, name)) for name in synthetic.DEFAULTS)
+    backends = args.backends.split(',')
+    
+    ncldoc = synthetic.build_document(**shape)
+    print('shape: %s' % ', '.join('%s=%d' % item for item in sorted(shape.items())))
+    print('entities: %d, output: %s MB' % (synthetic.count_entities(ncldoc),
+                                          megabytes(len(ncldoc.dump(streaming=True)))))
+    del ncldoc
+    print('')
+    # The incremental backend serves later runs from its cache, so its first
+    # and best times are the full and the unchanged re-dump respectively
+    print('%-10s %-12s %9s %9s %14s %14s' % ('phase', 'backend', 'first s', 'best s',
+                                            'heap peak MB', 'rss growth MB'))
+    for phase, _, per_backend in PHASES:
+        for backend in (backends if per_backend else ['-']):
+            result = isolated(phase, shape, backend, args.repeat)
+            if 'error' in result:
+                print('%-10s %-12s %s' % (phase, backend, result['error']))
+            else:
+                print('%-10s %-12s %9.3f %9.3f %14s %14s' % (phase, backend, result['first'],
+                                                            result['best'],
+                                                            megabytes(result['heap_peak']),
+                                                            megabytes(result['rss_growth'])))
+
+
+if __name__ == '__main__':
+    main()
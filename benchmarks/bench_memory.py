@@ -0,0 +1,82 @@
+# Per-instance memory of the anchor classes, compared with the same
+# attributes kept in a plain per-instance __dict__ (the layout Area and
+# NodeProperty had before they declared __slots__). Both variants register
+# in the id registry, so its share of the cost is the same on each side.
+#
+#   python benchmarks/bench_memory.py [count]
+
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyncl
+
+
+class DictArea(object):
+    def __init__(self, mid, coords=None, begin=None, end=None, beginText=None,
+                 endText=None, beginPosition=None, endPosition=None, first=None,
+                 last=None, label=None, clip=None):
+        self.id = mid
+        self.missing_id = None
+        pyncl.current_registry().register(self)
+        self.coords = coords
+        self.begin = begin
+        self.end = end
+        self.beginText = beginText
+        self.endText = endText
+        self.beginPosition = beginPosition
+        self.endPosition = endPosition
+        self.first = first
+        self.last = last
+        self.label = label
+        self.clip = clip
+
+
+class DictNodeProperty(object):
+    def __init__(self, name, value=None, externable=None):
+        self.id = pyncl.NclEntity.generate_id()
+        self.missing_id = True
+        pyncl.current_registry().register(self)
+        self.name = name
+        self.value = value
+        self.externable = externable
+
+
+def measure(factory, count):
+    # ids are built before tracing so only the instances themselves count
+    ids = ['area%d' % i for i in range(count)]
+    scope = pyncl.id_scope()
+    scope.__enter__()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    instances = [factory(mid, i) for i, mid in enumerate(ids)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    scope.__exit__(None, None, None)
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    # the list holding the instances is not part of their cost
+    size -= sys.getsizeof(instances)
+    return float(size) / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = [('Area', 
+             measure(lambda mid, i: DictArea(mid, begin=i), count),
+             measure(lambda mid, i: pyncl.Area(mid, begin=i), count)),
+            ('NodeProperty', 
+             measure(lambda mid, i: DictNodeProperty('visible', 'true'), count),
+             measure(lambda mid, i: pyncl.NodeProperty('visible', 'true'), count)),
+            ('NodeProperty.intern', 
+             measure(lambda mid, i: DictNodeProperty('visible', 'true'), count),
+             measure(lambda mid, i: pyncl.NodeProperty.intern('visible', 'true'), count))]
+    
+    print('%-20s %12s %12s %12s' % ('class', '__dict__ B', 'compact B', 'saved B'))
+    for name, dict_size, compact_size in rows:
+        print('%-20s %12.1f %12.1f %12.1f' % (name, dict_size, compact_size, 
+                                              dict_size - compact_size))
+
+
+if __name__ == '__main__':
+    main()
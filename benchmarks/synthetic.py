@@ -0,0 +1,97 @@
+# Synthetic NCL documents of a chosen size and shape, for the benchmarks.
+#
+#   regions            regions in the region base
+#   depth              regions are nested in chains this deep
+#   descriptors        descriptors, spread over the regions
+#   contexts           contexts in the body, each with a port
+#   media              media per context
+#   anchors            temporal areas per media
+#   links              links per context, two binds each
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pyncl
+
+
+DEFAULTS = {'regions': 100, 'depth': 3, 'descriptors': 100, 'contexts': 50,
+            'media': 2, 'anchors': 1000, 'links': 20}
+
+
+def build_document(regions=100, depth=3, descriptors=100, contexts=50, media=2,
+                   anchors=1000, links=20):
+    # Every document gets a registry of its own, so several can coexist
+    with pyncl.id_scope():
+        return _build_document(regions, depth, descriptors, contexts, media, 
+                               anchors, links)
+
+
+def _build_document(regions, depth, descriptors, contexts, media, anchors, links):
+    ncldoc = pyncl.NclDocument('synthetic')
+    
+    all_regions = []
+    parent = None
+    for i in range(regions):
+        if i % depth == 0:
+            region = pyncl.Region('r%d' % i, zIndex=i % 8, left='10%', top='10%', 
+                                  width='80%', height='80%')
+            ncldoc.region_base.append(region)
+        else:
+            region = pyncl.Region('r%d' % i, left=i % 100, top=i % 50, 
+                                  width=200, height=100)
+            parent.add_region(region)
+        all_regions.append(region)
+        parent = region
+    
+    all_descriptors = []
+    for i in range(descriptors):
+        if i % 4 == 0:
+            descriptor = pyncl.Descriptor('d%d' % i, region=all_regions[i % regions],
+                                          focusIndex='f%d' % i, focusBorderWidth=2,
+                                          focusSrc='images/focus%d.png' % i)
+        else:
+            descriptor = pyncl.Descriptor('d%d' % i, region=all_regions[i % regions],
+                                          freeze=i % 2 == 0, explicitDur='%ds' % i)
+        ncldoc.descriptor_base.append(descriptor)
+        all_descriptors.append(descriptor)
+    
+    ncldoc.add_imported_connector_base(pyncl.ImportedBase('conn', 'connBase.ncl'))
+    
+    for c in range(contexts):
+        context = pyncl.Context('ctx%d' % c)
+        ncldoc.add_node(context)
+        ncldoc.add_anchor(pyncl.Port('pCtx%d' % c, component=context))
+        
+        context_media = []
+        for m in range(media):
+            node = pyncl.Media('m%d_%d' % (c, m), src='videos/video%d_%d.mp4' % (c, m),
+                               descriptor=all_descriptors[(c * media + m) % descriptors])
+            node.add_anchor(pyncl.NodeProperty('bounds'))
+            node.add_anchor(pyncl.NodeProperty('visible', 'true'))
+            for a in range(anchors):
+                node.add_anchor(pyncl.Area('a%d_%d_%d' % (c, m, a), begin=a * 0.5, 
+                                           end=a * 0.5 + 0.25))
+            context.add_node(node)
+            context_media.append(node)
+        if media > 0:
+            context.add_anchor(pyncl.Port('p%d' % c, component=context_media[0]))
+        
+        for l in range(links):
+            link = pyncl.Link('conn#onBeginStart', 'l%d_%d' % (c, l))
+            source = context_media[l % media]
+            target = context_media[(l + 1) % media]
+            interface = None
+            if anchors > 0:
+                interface = 'a%d_%d_%d' % (c, l % media, l % anchors)
+            link.add_bind(pyncl.Bind('onBegin', source, interface=interface))
+            bind = pyncl.Bind('start', target)
+            bind.add_param('delay', '%ds' % l)
+            link.add_bind(bind)
+            context.add_link(link)
+    
+    return ncldoc
+
+
+def count_entities(ncldoc):
+    return len(ncldoc.registry)
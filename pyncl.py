@@ -1,7 +1,470 @@
-from lxml import etree as ET
+from bisect import bisect_right
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+import csv
+from gzip import GzipFile
+from heapq import heappop, heappush
+from io import BytesIO
+from itertools import count
+import json
+import os
+import re
+from string import Formatter
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+from time import perf_counter
+import traceback
+import tracemalloc
+import warnings
+from weakref import WeakKeyDictionary
+try:
+    from lxml import etree as ET
+except ImportError:
+    # Only the tree serializer, the lxml streaming serializer, the loader and
+    # the diff need lxml; without it dump and dump_file use XmlTextStream
+    ET = None
+try:
+    import numpy as np
+except ImportError:
+    # Only RegionLayout.arrays and the layout check need NumPy
+    np = None
 
 def clear():
-    NclEntity.IDS = {}
+    current_registry().clear()
+
+class UuidIdAllocator:
+    # The original scheme: globally unique, but slow and 36 characters long
+    def allocate(self, namespace=None):
+        import uuid
+        return str(uuid.uuid4())
+
+class SequentialIdAllocator:
+    # Hands out prefix + namespace + counter, one monotonic counter per
+    # namespace. Give every worker process its own worker name and the ids
+    # stay unique when their documents are merged afterwards.
+    def __init__(self, worker=None, prefix='_'):
+        if worker != None:
+            prefix = prefix + str(worker) + '_'
+        self.prefix = prefix
+        self.__counters = {}
+        
+    def allocate(self, namespace=None):
+        counter = self.__counters.get(namespace)
+        if counter == None:
+            counter = self.__counters.setdefault(namespace, count(1))
+        if namespace == None:
+            return self.prefix + str(next(counter))
+        return self.prefix + namespace + str(next(counter))
+
+class ReferenceIndex:
+    # Reverse of the references between entities: for every referred id, the
+    # ports, binds, media, contexts and descriptors pointing at it. Entities
+    # keep it up to date when one of their REFERENCES attributes is set.
+    def __init__(self):
+        self.__referrers = {}
+        
+    @staticmethod
+    def key(target):
+        if target == None or isinstance(target, str):
+            return target
+        return target.id
+    
+    def add(self, referrer, target):
+        key = ReferenceIndex.key(target)
+        if key == None:
+            return
+        referrers = self.__referrers.get(key)
+        if referrers == None:
+            referrers = self.__referrers[key] = {}
+        referrers[referrer] = None
+        
+    def discard(self, referrer, target):
+        key = ReferenceIndex.key(target)
+        referrers = self.__referrers.get(key)
+        if referrers != None:
+            referrers.pop(referrer, None)
+            if len(referrers) == 0:
+                del self.__referrers[key]
+                
+    def discard_all(self, referrer):
+        for name in referrer.REFERENCES:
+            self.discard(referrer, getattr(referrer, name, None))
+    
+    def referrers(self, target):
+        return list(self.__referrers.get(ReferenceIndex.key(target), ()))
+
+def track_reference(entity, name, value):
+    # Called by __setattr__ of the entities that refer to others. The index
+    # is that of the registry the entity was created in, whatever scope is
+    # active now.
+    if name in entity.REFERENCES:
+        registry = getattr(entity, 'registry', None)
+        if registry == None:
+            registry = current_registry()
+        references = registry.references
+        references.discard(entity, getattr(entity, name, None))
+        references.add(entity, value)
+
+class UnresolvedReference:
+    # Stands for an entity referred to by an id that was not registered yet,
+    # until IdRegistry.resolve replaces it. It has the id of the entity, so
+    # it serializes the same way.
+    __slots__ = ('id', 'cls')
+    
+    def __init__(self, mid, cls):
+        self.id = mid
+        self.cls = cls
+        
+    def __repr__(self):
+        return '<UnresolvedReference %s %s>' % (self.cls.__name__, self.id)
+
+class IdRegistry:
+    # Maps ids to the entities created while it is the active registry.
+    # Outside any id_scope() that is DEFAULT_REGISTRY, shared by the whole
+    # process and only emptied by clear(). Build each document inside its
+    # own id_scope() to have its entities released together with it and
+    # to keep documents built in different threads from sharing ids.
+    # With deferred, ids of entities not created yet are accepted as
+    # references and resolved in one pass by resolve(), so entities can be
+    # created in any order.
+    def __init__(self, allocator=None, deferred=False):
+        if allocator == None:
+            allocator = SequentialIdAllocator()
+        self.allocator = allocator
+        self.deferred = deferred
+        self.references = ReferenceIndex()
+        self.__entities = {}
+        self.__unresolved = []
+        # The areas of AreaBlocks are not registered one by one: blocks with
+        # an id list map each id to (block, index), numbered blocks are
+        # found by prefix and range
+        self.__block_ids = {}
+        self.__block_prefixes = {}
+        # Structure key -> Connector, see Connector.intern
+        self.interned_connectors = {}
+        # (name, value, externable) -> NodeProperty, see NodeProperty.intern
+        self.interned_properties = {}
+        
+    def generate_id(self, namespace=None):
+        mid = self.allocator.allocate(namespace)
+        while mid in self:
+            mid = self.allocator.allocate(namespace)
+        return mid
+        
+    def register(self, entity):
+        if entity.id in self:
+            raise ValueError("The NclEntity id must be unique in a NCL document: " + entity.id)
+        self.__entities[entity.id] = entity
+        
+    def alias(self, mid, entity):
+        # Makes mid one more id of a registered entity, for merged duplicates
+        if mid in self:
+            raise ValueError("The NclEntity id must be unique in a NCL document: " + mid)
+        self.__entities[mid] = entity
+        
+    def register_block(self, block):
+        for mid in block.get_ids():
+            if mid in self:
+                raise ValueError("The NclEntity id must be unique in a NCL document: " + mid)
+        if isinstance(block.ids, str):
+            self.__block_prefixes.setdefault(block.ids, []).append(block)
+        else:
+            for index, mid in enumerate(block.ids):
+                self.__block_ids[mid] = (block, index)
+        
+    def unregister(self, entity):
+        # Also drops the references the entity holds, so that the index does
+        # not keep it alive
+        self.references.discard_all(entity)
+        if isinstance(entity, AreaBlock):
+            if isinstance(entity.ids, str):
+                blocks = self.__block_prefixes.get(entity.ids, [])
+                if entity in blocks:
+                    blocks.remove(entity)
+                if len(blocks) == 0:
+                    self.__block_prefixes.pop(entity.ids, None)
+            else:
+                for mid in entity.ids:
+                    if self.__block_ids.get(mid, (None,))[0] is entity:
+                        del self.__block_ids[mid]
+        elif self.__entities.get(entity.id) is entity:
+            del self.__entities[entity.id]
+    
+    def __block_area(self, mid):
+        # The Area standing for an area of a block, or None
+        if not isinstance(mid, str):
+            return None
+        entry = self.__block_ids.get(mid)
+        if entry != None:
+            return entry[0].get_area(entry[1])
+        if len(self.__block_prefixes) == 0:
+            return None
+        split = len(mid)
+        while split > 0 and '0' <= mid[split - 1] <= '9':
+            split -= 1
+        for split in range(split, len(mid)):
+            number = mid[split:]
+            if len(number) > 1 and number[0] == '0':
+                continue
+            for block in self.__block_prefixes.get(mid[:split], ()):
+                index = int(number) - block.start
+                if 0 <= index < block.count:
+                    return block.get_area(index)
+        return None
+    
+    def get(self, mid, default=None):
+        entity = self.__entities.get(mid)
+        if entity == None:
+            entity = self.__block_area(mid)
+        return entity if entity != None else default
+    
+    def reference(self, entity, name, mid, cls):
+        # The entity that entity.name refers to by mid, or a placeholder
+        # for it when deferred
+        target = self.get(mid)
+        if target != None or not self.deferred:
+            return self[mid]
+        return self.defer(entity, name, UnresolvedReference(mid, cls))
+    
+    def defer(self, entity, name, reference):
+        # Leaves the placeholder in entity.name until resolve() finds the
+        # entity it stands for
+        self.__unresolved.append((entity, name, reference))
+        return reference
+    
+    def resolve(self):
+        # Replaces the placeholders whose entity exists now and returns the
+        # (entity, name, reference) triples that are still unresolved
+        unresolved = []
+        for entity, name, reference in self.__unresolved:
+            if getattr(entity, name, None) is not reference:
+                continue
+            target = self.get(reference.id)
+            if target == None or not isinstance(target, reference.cls):
+                unresolved.append((entity, name, reference))
+            else:
+                # The output and the reference index only depend on the id,
+                # so the placeholder is swapped without touching caches
+                object.__setattr__(entity, name, target)
+        self.__unresolved = unresolved
+        return list(unresolved)
+    
+    def clear(self):
+        self.__entities.clear()
+        self.__unresolved = []
+        self.references = ReferenceIndex()
+        self.__block_ids.clear()
+        self.__block_prefixes.clear()
+        self.interned_connectors = {}
+        self.interned_properties = {}
+        
+    def __getitem__(self, mid):
+        entity = self.get(mid)
+        if entity == None:
+            raise KeyError(mid)
+        return entity
+    
+    def __contains__(self, mid):
+        return mid in self.__entities or self.__block_area(mid) != None
+    
+    def __iter__(self):
+        return iter(self.__entities)
+    
+    def __len__(self):
+        return len(self.__entities)
+
+DEFAULT_REGISTRY = IdRegistry()
+_ACTIVE_REGISTRY = ContextVar('pyncl_registry')
+
+def current_registry():
+    return _ACTIVE_REGISTRY.get(DEFAULT_REGISTRY)
+
+@contextmanager
+def id_scope(registry=None):
+    # Entities created inside the with block register in the given (or a
+    # fresh) registry. Context variables are local to each thread, so every
+    # worker can keep its own scope open without any locking.
+    if registry == None:
+        registry = IdRegistry()
+    token = _ACTIVE_REGISTRY.set(registry)
+    try:
+        yield registry
+    finally:
+        _ACTIVE_REGISTRY.reset(token)
+
+class CurrentRegistry:
+    # Stands in for the old process-wide NclEntity.IDS dict and forwards
+    # every access to the registry of the active scope.
+    def __getitem__(self, mid):
+        return current_registry()[mid]
+    
+    def __contains__(self, mid):
+        return mid in current_registry()
+    
+    def __iter__(self):
+        return iter(current_registry())
+    
+    def __len__(self):
+        return len(current_registry())
+    
+    def get(self, mid, default=None):
+        return current_registry().get(mid, default)
+    
+    def reference(self, entity, name, mid, cls):
+        return current_registry().reference(entity, name, mid, cls)
+
+class XmlWriter:
+    # Interface shared by the streaming serializers. Entities describe their
+    # markup with element(), for elements that may get children, and leaf().
+    # Every implementation indents like ET.tostring(..., pretty_print=True),
+    # so all of them produce the same bytes as the tree based dump.
+    INDENT = '  '
+    
+    def write_entity(self, entity):
+        # For entities that only know how to build themselves with to_xml:
+        # they are built on a scratch parent that is dropped once written
+        xml_scratch = ET.Element('scratch')
+        entity.to_xml(xml_scratch)
+        for xml_element in xml_scratch:
+            self.write(xml_element)
+    
+    def write(self, xml_element):
+        if len(xml_element) > 0:
+            with self.element(xml_element.tag, xml_element.attrib):
+                for xml_child in xml_element:
+                    self.write(xml_child)
+        else:
+            self.leaf(xml_element.tag, xml_element.attrib)
+
+class XmlStream(XmlWriter):
+    # Writes elements to an lxml xmlfile as the model is walked. The start
+    # tag of an element is only written when its first child arrives, so
+    # childless elements still come out self-closed.
+    def __init__(self, xf):
+        self.__xf = xf
+        self.__open = []
+        
+    def __start(self):
+        for depth, entry in enumerate(self.__open):
+            if entry[2] == None:
+                if depth > 0:
+                    self.__xf.write('\n' + self.INDENT * depth)
+                entry[2] = self.__xf.element(entry[0], entry[1])
+                entry[2].__enter__()
+                
+    @contextmanager
+    def element(self, tag, attrib=None):
+        self.__start()
+        self.__open.append([tag, attrib or {}, None])
+        yield
+        tag, attrib, context = self.__open.pop()
+        depth = len(self.__open)
+        if context != None:
+            self.__xf.write('\n' + self.INDENT * depth)
+            context.__exit__(None, None, None)
+        else:
+            self.__write_indent(depth)
+            self.__xf.write(ET.Element(tag, attrib))
+    
+    def leaf(self, tag, attrib=None):
+        self.__start()
+        self.__write_indent(len(self.__open))
+        self.__xf.write(ET.Element(tag, attrib))
+            
+    def __write_indent(self, depth):
+        if depth > 0:
+            self.__xf.write('\n' + self.INDENT * depth)
+
+class XmlTextStream(XmlWriter):
+    # Writes the markup as text straight to a binary file-like object, with
+    # the same escaping as libxml2 and without creating any lxml element.
+    # depth is the indentation level of the first element, for fragments.
+    # compact drops all whitespace between elements and sorts attributes by
+    # name, so equal documents give equal bytes however they were built.
+    # Text is buffered, call flush() once done.
+    ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;',
+                             '\t': '&#9;', '\n': '&#10;', '\r': '&#13;'})
+    # Characters XML 1.0 does not allow at all, which lxml refuses as well
+    INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+    BUFFERED_PARTS = 4096
+    
+    def __init__(self, output, encoding=None, depth=0, compact=False):
+        self.__output = output
+        self.__encoding = encoding or 'ascii'
+        self.__depth = depth
+        self.__compact = compact
+        self.__open = []
+        self.__parts = []
+        
+    def __indent(self, depth):
+        if depth == 0 or self.__compact:
+            return ''
+        return '\n' + self.INDENT * depth
+    
+    def __tag(self, tag, attrib, end):
+        if not attrib:
+            return '<' + tag + end
+        escapes = self.ESCAPES
+        items = attrib.items()
+        if self.__compact:
+            items = sorted(items)
+        text = '<%s %s%s' % (tag, ' '.join(['%s="%s"' % (name, value.translate(escapes))
+                                            for name, value in items]), end)
+        if self.INVALID.search(text) != None:
+            raise ValueError('All strings must be XML compatible: no NULL bytes or control '
+                             'characters: ' + repr(text))
+        return text
+    
+    def __start(self):
+        for index, entry in enumerate(self.__open):
+            if not entry[2]:
+                self.__parts.append(self.__indent(self.__depth + index) + 
+                                    self.__tag(entry[0], entry[1], '>'))
+                entry[2] = True
+        
+    @contextmanager
+    def element(self, tag, attrib=None):
+        self.__start()
+        self.__open.append([tag, attrib, False])
+        yield
+        tag, attrib, started = self.__open.pop()
+        depth = self.__depth + len(self.__open)
+        if started:
+            self.__parts.append(('' if self.__compact else '\n' + self.INDENT * depth) + 
+                                '</' + tag + '>')
+        else:
+            self.__parts.append(self.__indent(depth) + self.__tag(tag, attrib, '/>'))
+        if len(self.__parts) >= self.BUFFERED_PARTS:
+            self.flush()
+            
+    def leaf(self, tag, attrib=None):
+        self.__start()
+        self.__parts.append(self.__indent(self.__depth + len(self.__open)) + 
+                            self.__tag(tag, attrib, '/>'))
+        if len(self.__parts) >= self.BUFFERED_PARTS:
+            self.flush()
+        
+    def raw(self, data):
+        # Already serialized bytes, including their leading indentation
+        self.__start()
+        self.flush()
+        self.__output.write(data)
+        
+    def flush(self):
+        if len(self.__parts) > 0:
+            self.__output.write(''.join(self.__parts).encode(self.__encoding, 
+                                                             'xmlcharrefreplace'))
+            self.__parts = []
+
+class ByteCounter:
+    # Binary file-like object that only counts the bytes written to it
+    def __init__(self):
+        self.size = 0
+        
+    def write(self, data):
+        self.size += len(data)
 
 class ImportedBase:
     RULE_BASE = 0
@@ -17,25 +480,112 @@ class ImportedBase:
         self.baseId = baseId
         self.base_type = base_type
         
-    def to_xml(self, xml_base):
-        xml_imported_base = ET.SubElement(xml_base, 'importBase', 
-                                          alias=self.alias, 
-                                          documentURI=self.documentURI)
+    def xml_attrib(self):
+        attrib = {'alias': self.alias, 'documentURI': self.documentURI}
         
         if self.region != None:
-            xml_imported_base.attrib['region'] = self.region.id
+            attrib['region'] = self.region.id
             
         if self.baseId != None:
-            xml_imported_base.attrib['baseId'] = self.baseId
+            attrib['baseId'] = self.baseId
+        return attrib
+    
+    def load_connectors(self, base_dir=None, cache=None):
+        # The ConnectorBase of the imported document, whose relative
+        # documentURI is taken from base_dir (by default the working directory)
+        path = self.documentURI
+        if base_dir != None and not os.path.isabs(path):
+            path = os.path.join(base_dir, path)
+        if cache == None:
+            cache = CONNECTOR_BASES
+        return cache.load(path)
+        
+    def to_xml(self, xml_base):
+        ET.SubElement(xml_base, 'importBase', self.xml_attrib())
+            
+    def write_xml(self, xml_stream):
+        xml_stream.leaf('importBase', self.xml_attrib())
         
 
+class ConnectorBase:
+    # The causal connectors of an imported NCL file: connector id to the
+    # roles its conditions, actions and assessments declare
+    def __init__(self, path, connectors):
+        self.path = path
+        self.connectors = connectors
+        
+    @staticmethod
+    def parse(path):
+        if ET == None:
+            raise ImportError('lxml is required to load imported connector bases')
+        connectors = {}
+        for event, xml_element in ET.iterparse(path, events=('end',)):
+            if ET.QName(xml_element).localname == 'causalConnector':
+                roles = [xml_child.get('role') for xml_child in xml_element.iter()]
+                connectors[xml_element.get('id')] = frozenset(role for role in roles 
+                                                               if role != None)
+                xml_element.clear()
+        return ConnectorBase(path, connectors)
+    
+    def __contains__(self, connector_id):
+        return connector_id in self.connectors
+    
+    def get_roles(self, connector_id):
+        return self.connectors[connector_id]
+    
+class ConnectorBaseCache:
+    # Bounded LRU of parsed connector bases, shared by every document that
+    # imports them. Entries are keyed by the resolved path and parsed again
+    # when the modification time or the size of the file changes.
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.__bases = OrderedDict()
+        self.__lock = Lock()
+        
+    def load(self, path):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.__lock:
+            entry = self.__bases.get(path)
+            if entry != None and entry[0] == stamp:
+                self.__bases.move_to_end(path)
+                return entry[1]
+        # Parsed outside the lock, at worst twice by concurrent threads
+        connector_base = ConnectorBase.parse(path)
+        with self.__lock:
+            self.__bases[path] = (stamp, connector_base)
+            self.__bases.move_to_end(path)
+            while len(self.__bases) > self.max_size:
+                self.__bases.popitem(last=False)
+        return connector_base
+    
+    def clear(self):
+        with self.__lock:
+            self.__bases.clear()
+            
+    def __len__(self):
+        return len(self.__bases)
+
+CONNECTOR_BASES = ConnectorBaseCache()
+
 class NclDocument:
-    def __init__(self, mid, bodyid=None):
+    # Bytes of links dump_rows keeps in memory while a media is open
+    SPOOL_SIZE = 1 << 20
+    
+    def __init__(self, mid, bodyid=None, registry=None):
         self.id = mid
+        if registry == None:
+            registry = current_registry()
+        self.registry = registry
         self.region_base = []
         self.descriptor_base = []
         self.connector_base = []
         self.transition_base = []
+        # Ids of the base elements, which editing commands refer to
+        self.region_base_id = None
+        self.descriptor_base_id = None
+        self.connector_base_id = None
         self.bodyid = bodyid
         
         self.body = None
@@ -44,25 +594,404 @@ class NclDocument:
         self.__imported_regions_base = []
         self.__aliases = {}
         self.__elements = {}
+        self.__connectors = {}
+        self.__indexed_connectors = 0
+        
+    @staticmethod
+    def load(source, streaming=False, registry=None, strict=False):
+        return NclLoader(registry, strict).load(source, streaming)
+    
+    def scope(self):
+        # The registry the document was created under: DEFAULT_REGISTRY
+        # unless it was made inside an id_scope() or given one
+        return id_scope(self.registry)
+    
+    def diff(self, other, base_id=None):
+        return NclDiff(self, other, base_id).commands()
+    
+    def validate(self, base_dir=None, cache=None):
+        # With base_dir, aliased xconnectors and their bind roles are checked
+        # against the imported connector bases, read through cache
+        self.registry.resolve()
+        return NclValidator(self, base_dir, cache).errors()
+    
+    def check_layout(self, screen=None):
+        return RegionLayout(self, screen).check()
+    
+    def assign_focus(self, descriptors=None, screen=None):
+        self.resolve()
+        return FocusNavigator(self, descriptors, screen).assign()
+    
+    def timeline(self):
+        self.resolve()
+        return NclScheduler(self).timeline()
+    
+    def deduplicate(self):
+        self.resolve()
+        with self.scope():
+            return NclDeduplicator(self).merge()
+    
+    def resolve(self):
+        unresolved = self.registry.resolve()
+        if len(unresolved) > 0:
+            raise ValueError('Unresolved references: ' + 
+                             ', '.join([reference.id for entity, name, reference in unresolved]))
+    
+    def find_referrers(self, target, cls=None):
+        referrers = self.registry.references.referrers(target)
+        if cls != None:
+            referrers = [referrer for referrer in referrers if isinstance(referrer, cls)]
+        return referrers
+    
+    def find_links(self, target):
+        links = {}
+        for bind in self.find_referrers(target, Bind):
+            if bind.link != None:
+                links[bind.link] = None
+        return list(links)
+    
+    def remove_node(self, node):
+        # Removes the node and everything under it, together with the links
+        # binding to any of them or to their anchors, the ports leading to
+        # them and, in turn, whatever refers to those ports, and the nodes
+        # that refer to removed nodes
+        references = self.registry.references
+        pending = [node]
+        while len(pending) > 0:
+            entity = pending.pop()
+            if entity.parent == None:
+                continue
+            if isinstance(entity, Port):
+                entity.parent.remove_anchor(entity)
+                entity.parent = None
+                removed = [entity]
+            else:
+                entity.parent.remove_node(entity)
+                removed = self.__subtree(entity)
+            
+            targets = []
+            for target in removed:
+                targets.append(target.id)
+                if isinstance(target, Node):
+                    for anchor in target.get_anchors():
+                        if isinstance(anchor, AreaBlock):
+                            targets.extend(anchor.get_ids())
+                        elif not isinstance(anchor, NodeProperty):
+                            targets.append(anchor.id)
+            for target in targets:
+                for referrer in references.referrers(target):
+                    if isinstance(referrer, Bind):
+                        link = referrer.link
+                        if link != None and link.parent != None:
+                            link.parent.remove_link(link)
+                            self.__forget_link(link)
+                    elif isinstance(referrer, (Port, Node)):
+                        pending.append(referrer)
+            for target in removed:
+                self.__forget(target)
+                
+    def __subtree(self, node):
+        nodes = [node]
+        index = 0
+        while index < len(nodes):
+            if isinstance(nodes[index], Context):
+                nodes.extend(nodes[index].get_nodes())
+            index += 1
+        return nodes
+    
+    def __forget(self, entity):
+        self.registry.unregister(entity)
+        if isinstance(entity, Node):
+            for anchor in entity.get_anchors():
+                self.__forget(anchor)
+        if isinstance(entity, Context):
+            for link in entity.get_links():
+                self.__forget_link(link)
+                
+    def __forget_link(self, link):
+        for bind in link.get_binds():
+            self.registry.references.discard_all(bind)
+        self.registry.unregister(link)
+    
+    def add_connector(self, connector):
+        # Adds the connector unless one with the same structure is already
+        # in the connector base, and returns the one links should refer to
+        if not isinstance(connector, Connector):
+            raise TypeError('The argument must be an instance of Connector')
+        for known in self.connector_base[self.__indexed_connectors:]:
+            self.__connectors.setdefault(known.key, known)
+        self.__indexed_connectors = len(self.connector_base)
+        
+        survivor = self.__connectors.get(connector.key)
+        if survivor != None:
+            if survivor is not connector:
+                self.__merge_connector(connector, survivor)
+            return survivor
+        if self.registry.get(connector.id) is not connector:
+            self.registry.register(connector)
+        self.connector_base.append(connector)
+        self.__connectors[connector.key] = connector
+        self.__indexed_connectors += 1
+        return connector
+    
+    def __merge_connector(self, duplicate, survivor):
+        # Links built on the duplicate move to the survivor, and the id of
+        # the duplicate becomes an alias of the survivor for links to come
+        for link in self.registry.references.referrers(duplicate):
+            if isinstance(link, Link) and link.get_xconnector() is duplicate:
+                link.set_xconnector(survivor)
+        if self.registry.get(duplicate.id) is duplicate:
+            self.registry.unregister(duplicate)
+            self.registry.alias(duplicate.id, survivor)
+    
+    def get_imported_bases(self):
+        return (self.__imported_regions_base + self.__imported_descriptors_base + 
+                self.__imported_connectors_base)
+    
+    def get_imported_connectors(self, base_dir=None, cache=None):
+        return dict((imported_base.alias, imported_base.load_connectors(base_dir, cache)) 
+                    for imported_base in self.__imported_connectors_base)
+    
+    def add_imported_region_base(self, imported_base):
+        imported_base.base_type = ImportedBase.REGION_BASE
+        self.__imported_regions_base.append(imported_base)
+        self.__aliases[imported_base.alias] = imported_base
+        
+    def add_imported_descriptor_base(self, imported_base):
+        imported_base.base_type = ImportedBase.DESCRIPTOR_BASE
+        self.__imported_descriptors_base.append(imported_base)
+        self.__aliases[imported_base.alias] = imported_base
         
     def add_imported_connector_base(self, imported_base):
         imported_base.base_type = ImportedBase.CONNECTOR_BASE
         self.__imported_connectors_base.append(imported_base)
         self.__aliases[imported_base.alias] = imported_base
         
-    def dump(self):
-        xml_doc = self.__to_xml()
-        return ET.tostring(xml_doc, pretty_print=True)
+    def dump(self, streaming=False, incremental=False, text=False, compact=False, 
+             compress=False):
+        # compact gives the minified, canonical output of XmlTextStream and
+        # compress gzips the result
+        self.resolve()
+        if incremental or text or compact or ET == None:
+            output = BytesIO()
+            self.__write_text(output, incremental=incremental, compact=compact)
+            data = output.getvalue()
+        elif streaming:
+            output = BytesIO()
+            self.__write_xml(output)
+            data = output.getvalue()
+        else:
+            xml_doc = self.__to_xml()
+            data = ET.tostring(xml_doc, pretty_print=True)
+            
+        if compress:
+            output = BytesIO()
+            with GzipFile(filename='', mode='wb', fileobj=output, mtime=0) as gzip_file:
+                gzip_file.write(data)
+            data = output.getvalue()
+        return data
+    
+    def dump_file(self, filename, streaming=False, incremental=False, text=False, 
+                  compact=False, compress=False):
+        # filename may also be a binary file-like object, which is left open
+        self.resolve()
+        if hasattr(filename, 'write'):
+            self.__dump_to(filename, streaming, incremental, text, compact, compress)
+        else:
+            with open(filename, 'wb') as xml_file:
+                self.__dump_to(xml_file, streaming, incremental, text, compact, compress)
+                
+    def __dump_to(self, output, streaming, incremental, text, compact, compress):
+        if compress:
+            # A fixed mtime and no file name keep the gzip output deterministic
+            with GzipFile(filename='', mode='wb', fileobj=output, mtime=0) as gzip_file:
+                self.__dump_to(gzip_file, streaming, incremental, text, compact, False)
+            return
+        
+        if incremental or text or compact or ET == None:
+            self.__write_text(output, encoding="ISO-8859-1", xml_declaration=True, 
+                              incremental=incremental, compact=compact)
+        elif streaming:
+            self.__write_xml(output, encoding="ISO-8859-1", xml_declaration=True)
+        else:
+            xml_doc = self.__to_xml()
+            root = xml_doc.getroottree()
+            root.write(output, encoding="ISO-8859-1", pretty_print=True, xml_declaration=True)
+    
+    def dump_rows(self, filename, rows, mapping, batch_size=1000, compact=False, 
+                  compress=False):
+        # Like dump_file, with the body completed by the nodes and links that
+        # NclTableBuilder(mapping, batch_size) makes from rows. They are
+        # written and forgotten batch by batch, so memory stays flat however
+        # many rows there are. The body of the document comes first. Binds to
+        # nodes that no row made and that are not in the document are only
+        # found once everything is written, and raise a ValueError then.
+        builder = NclTableBuilder(mapping, batch_size)
+        self.resolve()
+        if hasattr(filename, 'write'):
+            self.__dump_rows_to(filename, rows, builder, compact, compress)
+        else:
+            with open(filename, 'wb') as xml_file:
+                self.__dump_rows_to(xml_file, rows, builder, compact, compress)
+        self.resolve()
+                
+    def __dump_rows_to(self, output, rows, builder, compact, compress):
+        if compress:
+            with GzipFile(filename='', mode='wb', fileobj=output, mtime=0) as gzip_file:
+                self.__dump_rows_to(gzip_file, rows, builder, compact, False)
+            return
+        
+        encoding = "ISO-8859-1"
+        newline = b'' if compact else b'\n'
+        output.write(("<?xml version='1.0' encoding='%s'?>" % encoding).encode('ascii') + newline)
+        xml_stream = XmlTextStream(output, encoding, compact=compact)
+        if self.body != None:
+            tag, attrib = self.body.xml_tag_attrib()
+        else:
+            tag, attrib = 'body', {'id': self.bodyid} if self.bodyid != None else {}
+        with xml_stream.element('ncl', self.__ncl_attrib()):
+            self.__head_to_stream(xml_stream)
+            with xml_stream.element(tag, attrib):
+                if self.body != None:
+                    for entity in self.body.get_anchors() + self.body.get_nodes() + \
+                                  self.body.get_links():
+                        entity.write_xml(xml_stream)
+                # The last media of a batch is left open, since the next
+                # batch may go on with its areas. Links cannot be written
+                # inside it, so until it ends they go to a spool file, which
+                # stays in memory while small.
+                context = None
+                context_element = None
+                media = None
+                media_element = None
+                spool = SpooledTemporaryFile(self.SPOOL_SIZE)
+                spool_stream = None
+                for batch_context, nodes, links in builder.batches(rows):
+                    if media != None and (batch_context is not context or nodes[0] is not media):
+                        self.__end_media(xml_stream, media_element, spool, spool_stream)
+                        media = None
+                    if batch_context is not context:
+                        if context_element != None:
+                            context_element.__exit__(None, None, None)
+                            builder.release([context], [])
+                        context = batch_context
+                        context_element = xml_stream.element(*context.xml_tag_attrib())
+                        context_element.__enter__()
+                    for node in nodes:
+                        if node is media:
+                            for anchor in node.get_anchors():
+                                anchor.write_xml(xml_stream)
+                            continue
+                        if media != None:
+                            self.__end_media(xml_stream, media_element, spool, spool_stream)
+                            media = None
+                        if node is not nodes[-1] or not isinstance(node, Media):
+                            node.write_xml(xml_stream)
+                        else:
+                            media = node
+                            media_element = xml_stream.element('media', media.xml_attrib())
+                            media_element.__enter__()
+                            for anchor in media.get_anchors():
+                                anchor.write_xml(xml_stream)
+                            spool_stream = XmlTextStream(spool, encoding, 
+                                                         3 if context != None else 2, compact)
+                    for link in links:
+                        link.write_xml(spool_stream if media != None else xml_stream)
+                    builder.release(nodes, links)
+                if media != None:
+                    self.__end_media(xml_stream, media_element, spool, spool_stream)
+                if context_element != None:
+                    context_element.__exit__(None, None, None)
+                    builder.release([context], [])
+                spool.close()
+        xml_stream.flush()
+        output.write(newline)
         
+    def __end_media(self, xml_stream, media_element, spool, spool_stream):
+        # Closes the media left open by __dump_rows_to and writes the links
+        # kept back meanwhile
+        media_element.__exit__(None, None, None)
+        spool_stream.flush()
+        spool.seek(0)
+        for data in iter(lambda: spool.read(self.SPOOL_SIZE), b''):
+            xml_stream.raw(data)
+        spool.seek(0)
+        spool.truncate()
+    
+    def xml_size(self, encoding=None, xml_declaration=False, compact=False):
+        # Exact length of the output, from the cached sizes of the nodes:
+        # xml_size() for dump(), xml_size('ISO-8859-1', True) for dump_file
+        self.resolve()
+        output = ByteCounter()
+        self.__write_text(output, encoding, xml_declaration, compact=compact, body=False)
+        if self.body != None:
+            output.size += self.body.xml_size(1, encoding, compact)
+        return output.size
+    
+    def __write_text(self, output, encoding=None, xml_declaration=False, incremental=False, 
+                     compact=False, body=True):
+        # With incremental, only contexts and media whose cache was dropped
+        # by touch() are serialized again, the others come from their cache
+        newline = b'' if compact else b'\n'
+        if xml_declaration:
+            output.write(("<?xml version='1.0' encoding='%s'?>" % encoding).encode('ascii') + 
+                         newline)
+        xml_stream = XmlTextStream(output, encoding, compact=compact)
+        with xml_stream.element('ncl', self.__ncl_attrib()):
+            self.__head_to_stream(xml_stream)
+            if self.body != None and body:
+                if incremental:
+                    xml_stream.raw(self.body.to_bytes(1, encoding, compact))
+                else:
+                    self.body.write_xml(xml_stream)
+        xml_stream.flush()
+        output.write(newline)
+    
+    def __write_xml(self, output, encoding=None, xml_declaration=False):
+        with ET.xmlfile(output, encoding=encoding) as xf:
+            if xml_declaration:
+                xf.write_declaration()
+            xml_stream = XmlStream(xf)
+            with xml_stream.element('ncl', self.__ncl_attrib()):
+                self.__head_to_stream(xml_stream)
+                if self.body != None:
+                    self.body.write_xml(xml_stream)
+        # xmlfile refuses text outside the root, so the newline that
+        # pretty_print leaves after it is written straight to the output
+        output.write(b'\n')
+                    
+    def __ncl_attrib(self):
+        return {'id': self.id, 'xmlns': "http://www.ncl.org.br/NCL3.0/EDTVProfile"}
     
-    def dump_file(self, filename):
-        xml_file = open(filename, 'w+')
-        xml_doc = self.__to_xml()
-        root = xml_doc.getroottree()
-        root.write(xml_file,  encoding="ISO-8859-1", pretty_print=True, xml_declaration=True)
+    def __base_attrib(self, base):
+        base_id = getattr(self, base + '_base_id')
+        return {'id': base_id} if base_id != None else {}
+        
+    def __head_to_stream(self, xml_stream):
+        with xml_stream.element("head"):
+            if len(self.region_base) > 0 or len(self.__imported_regions_base) > 0:
+                with xml_stream.element("regionBase", self.__base_attrib('region')):
+                    for region in self.region_base:
+                        region.write_xml(xml_stream)
+                    for imported_base in self.__imported_regions_base:
+                        imported_base.write_xml(xml_stream)
+                        
+            if len(self.region_base) > 0 or len(self.__imported_descriptors_base) > 0:
+                with xml_stream.element("descriptorBase", self.__base_attrib('descriptor')):
+                    for descriptor in self.descriptor_base:
+                        descriptor.write_xml(xml_stream)
+                    for imported_base in self.__imported_descriptors_base:
+                        imported_base.write_xml(xml_stream)
+                        
+            if len(self.connector_base) > 0 or len(self.__imported_connectors_base) > 0:
+                with xml_stream.element("connectorBase", self.__base_attrib('connector')):
+                    for connector in self.connector_base:
+                        connector.write_xml(xml_stream)
+                    for imported_base in self.__imported_connectors_base:
+                        imported_base.write_xml(xml_stream)
     
     def __to_xml(self):
-        xml_doc = ET.Element('ncl', id=self.id, xmlns="http://www.ncl.org.br/NCL3.0/EDTVProfile")
+        xml_doc = ET.Element('ncl', self.__ncl_attrib())
         self.__head_to_xml(xml_doc)
         self.__body_to_xml(xml_doc)
         return xml_doc
@@ -70,7 +999,7 @@ class NclDocument:
     def __head_to_xml(self, xml_doc):
         xml_head = ET.SubElement(xml_doc, "head")
         if len(self.region_base) > 0 or len(self.__imported_regions_base) > 0:
-            xml_base = ET.SubElement(xml_head, "regionBase")
+            xml_base = ET.SubElement(xml_head, "regionBase", self.__base_attrib('region'))
             for region in self.region_base:
                 region.to_xml(xml_base)
                 
@@ -78,7 +1007,7 @@ class NclDocument:
                 imported_base.to_xml(xml_base)
                 
         if len(self.region_base) > 0 or len(self.__imported_descriptors_base) > 0:
-            xml_base = ET.SubElement(xml_head, "descriptorBase")
+            xml_base = ET.SubElement(xml_head, "descriptorBase", self.__base_attrib('descriptor'))
             for descriptor in self.descriptor_base:
                 descriptor.to_xml(xml_base)
                 
@@ -86,7 +1015,7 @@ class NclDocument:
                 imported_base.to_xml(xml_base)
                 
         if len(self.connector_base) > 0 or len(self.__imported_connectors_base) > 0:
-            xml_base = ET.SubElement(xml_head, "connectorBase")
+            xml_base = ET.SubElement(xml_head, "connectorBase", self.__base_attrib('connector'))
             for connector in self.connector_base:
                 connector.to_xml(xml_base)
                 
@@ -119,23 +1048,31 @@ class NclDocument:
         
 
 class NclEntity:
-    IDS = {}
+    # Subclasses with many instances (anchors) declare __slots__ as well and
+    # so carry no per-instance __dict__; the others keep theirs.
+    # registry is the registry the entity was created in
+    __slots__ = ('id', 'missing_id', 'registry', '__weakref__')
+    IDS = CurrentRegistry()
+    # Attributes pointing at other entities, see ReferenceIndex
+    REFERENCES = ()
     def __init__(self, mid=None, missing_id=None):
+        object.__setattr__(self, 'registry', current_registry())
         if missing_id == True:
-            mid = NclEntity.generate_id()
-        elif self.IDS.has_key(mid):
-            raise ValueError("The NclEntity id must be unique in a NCL document: " + mid)    
+            mid = NclEntity.generate_id(type(self).__name__)
         self.id = mid
-        self.IDS[mid] = self
+        if mid != None:
+            current_registry().register(self)
         self.missing_id = missing_id
         
     @staticmethod
-    def generate_id():
-        import uuid
-        return str(uuid.uuid4())
+    def generate_id(namespace=None):
+        return current_registry().generate_id(namespace)
     
     def to_xml(self, parent_node):
         pass
+    
+    def write_xml(self, xml_stream):
+        xml_stream.write_entity(self)
 
 class Region(NclEntity):
     def __init__(self, mid, width=None, height=None, top=None, left=None, right=None, \
@@ -155,33 +1092,42 @@ class Region(NclEntity):
     def add_region(self, region):
         self.regions.append(region)
         
-    def to_xml(self, xml_root):
-        
-        xml_region = ET.SubElement(xml_root, 'region', id=self.id)
+    def xml_attrib(self):
+        attrib = {'id': self.id}
         if self.width != None:
-            xml_region.attrib['width'] = str(self.width)
+            attrib['width'] = str(self.width)
         if self.height != None:
-            xml_region.attrib['height'] = str(self.height)
+            attrib['height'] = str(self.height)
         if self.top != None:
-            xml_region.attrib['top'] = str(self.top)
+            attrib['top'] = str(self.top)
         if self.left != None:
-            xml_region.attrib['left'] = str(self.left)
+            attrib['left'] = str(self.left)
         if self.right != None:
-            xml_region.attrib['right'] = str(self.right)
+            attrib['right'] = str(self.right)
         if self.bottom != None:
-            xml_region.attrib['bottom'] = str(self.bottom)
+            attrib['bottom'] = str(self.bottom)
         if self.zIndex != None:
-            xml_region.attrib['zIndex'] = str(self.zIndex)
+            attrib['zIndex'] = str(self.zIndex)
         if self.title != None:
-            xml_region.attrib['title'] = self.title
-            
+            attrib['title'] = self.title
+        return attrib
+        
+    def to_xml(self, xml_root):
+        xml_region = ET.SubElement(xml_root, 'region', self.xml_attrib())
         
         for subregion in self.regions:
             subregion.to_xml(xml_region)
         
         return xml_region        
+    
+    def write_xml(self, xml_stream):
+        with xml_stream.element('region', self.xml_attrib()):
+            for subregion in self.regions:
+                subregion.write_xml(xml_stream)
 
 class Descriptor(NclEntity):
+    REFERENCES = ('region',)
+    
     def __init__(self, mid, player=None, explicitDur=None, \
                            region=None, freeze=None, moveLeft=None, moveRight=None, \
                            moveUp=None, moveDown=None, focusIndex=None, \
@@ -193,8 +1139,8 @@ class Descriptor(NclEntity):
         self.player = player
         self.explicitDur = explicitDur
         if isinstance(region, str):
-            region = NclEntity.IDS[region]
-        if region != None and not isinstance(region, Region):
+            region = NclEntity.IDS.reference(self, 'region', region, Region)
+        if region != None and not isinstance(region, (Region, UnresolvedReference)):
             raise TypeError('The region argument must be an instance of Region or' + 
                             ' the id of a valid Region instance')
         
@@ -215,6 +1161,10 @@ class Descriptor(NclEntity):
         self.transOut = transOut
         self.__descriptor_params = {}
         
+    def __setattr__(self, name, value):
+        track_reference(self, name, value)
+        NclEntity.__setattr__(self, name, value)
+        
     def add_transIn(self, transition):
         if self.transIn == None:
             self.transIn = []
@@ -228,97 +1178,384 @@ class Descriptor(NclEntity):
     def add_param(self, name, value):
         self.__descriptor_params[name] = value
         
-    def to_xml(self, xml_root):
-        xml_descriptor = ET.SubElement(xml_root, 'descriptor', id=self.id)
+    def xml_attrib(self):
+        attrib = {'id': self.id}
         
         if self.player != None:
-            xml_descriptor.attrib['player'] = str(self.player)
+            attrib['player'] = str(self.player)
         
         if self.explicitDur != None:
-            xml_descriptor.attrib['explicitDur'] = str(self.explicitDur)
+            attrib['explicitDur'] = str(self.explicitDur)
         
         if self.region != None:
-            xml_descriptor.attrib['region'] = self.region.id
+            attrib['region'] = self.region.id
             
         if self.freeze != None:
-            xml_descriptor.attrib['freeze'] = str(self.freeze).lower()
+            attrib['freeze'] = str(self.freeze).lower()
             
         if self.moveLeft != None:
-            xml_descriptor.attrib['moveLeft'] = self.moveLeft
+            attrib['moveLeft'] = self.moveLeft
         
         if self.moveRight != None:
-            xml_descriptor.attrib['moveRight'] = self.moveRight
+            attrib['moveRight'] = self.moveRight
         
         if self.moveUp != None:
-            xml_descriptor.attrib['moveUp'] = self.moveUp
+            attrib['moveUp'] = self.moveUp
             
         if self.moveDown != None:
-            xml_descriptor.attrib['moveDown'] = self.moveDown
+            attrib['moveDown'] = self.moveDown
             
         if self.focusIndex != None:
-            xml_descriptor.attrib['focusIndex'] = self.focusIndex
+            attrib['focusIndex'] = self.focusIndex
             
         if self.focusBorderColor != None:
-            xml_descriptor.attrib['focusBorderColor'] = self.focusBorderColor
+            attrib['focusBorderColor'] = self.focusBorderColor
             
         if self.focusBorderWidth != None:
-            xml_descriptor.attrib['focusBorderWidth'] = str(self.focusBorderWidth)
+            attrib['focusBorderWidth'] = str(self.focusBorderWidth)
             
         if self.focusBorderTransparency != None:
-            xml_descriptor.attrib['focusBorderTransparency'] = str(self.focusBorderTransparency)
+            attrib['focusBorderTransparency'] = str(self.focusBorderTransparency)
             
         if self.focusSrc != None:
-            xml_descriptor.attrib['focusSrc'] = self.focusSrc
+            attrib['focusSrc'] = self.focusSrc
             
         if self.focusSelSrc != None:
-            xml_descriptor.attrib['focusSelSrc'] = self.focusSelSrc
+            attrib['focusSelSrc'] = self.focusSelSrc
             
         if self.selBorderColor != None:
-            xml_descriptor.attrib['selBorderColor'] = self.selBorderColor
+            attrib['selBorderColor'] = self.selBorderColor
             
         if self.transIn != None and len(self.transIn) > 0:
             tmpstr = ""
             for transition in self.transIn:
                 tmpstr = tmpstr + transition.id
-            xml_descriptor.attrib['transIn'] = tmpstr
+            attrib['transIn'] = tmpstr
             
         if self.transOut != None and len(self.transOut) > 0:
             tmpstr = ""
             for transition in self.transOut:
                 tmpstr = tmpstr + transition.id
-            xml_descriptor.attrib['transOut'] = tmpstr
-        
+            attrib['transOut'] = tmpstr
+        return attrib
+    
+    def get_params(self):
+        return self.__descriptor_params
+    
+    def to_xml(self, xml_root):
+        ET.SubElement(xml_root, 'descriptor', self.xml_attrib())
         for name, value in self.__descriptor_params.items():
             ET.SubElement(xml_root, 'descriptorParam', name=name, value=value)
+            
+    def write_xml(self, xml_stream):
+        xml_stream.leaf('descriptor', self.xml_attrib())
+        for name, value in self.__descriptor_params.items():
+            xml_stream.leaf('descriptorParam', {'name': name, 'value': value})
+        
+
+class ConnectorPart:
+    # A condition, action or statement of a causal connector. Parts are
+    # immutable: attributes and children are given to the constructor, which
+    # also computes key, the structure of the part as nested tuples, and the
+    # roles it declares.
+    __slots__ = ('attrib', 'children', 'key', 'roles')
+    TAG = None
+    
+    def __init__(self, attrib, children=()):
+        self.attrib = dict((name, str(value)) for name, value in attrib.items() 
+                           if value != None)
+        self.children = tuple(children)
+        self.key = (self.TAG, tuple(sorted(self.attrib.items())), 
+                    tuple(child.key for child in self.children))
+        roles = set()
+        if 'role' in self.attrib:
+            roles.add(self.attrib['role'])
+        for child in self.children:
+            roles.update(child.roles)
+        self.roles = frozenset(roles)
+        
+    @staticmethod
+    def check(parts, types, name):
+        for part in parts:
+            if not isinstance(part, types):
+                raise TypeError('The %s argument must contain instances of %s' % 
+                                (name, ' or '.join([cls.__name__ for cls in types])))
         
+    def to_xml(self, parent_node):
+        xml_element = ET.SubElement(parent_node, self.TAG, self.attrib)
+        for child in self.children:
+            child.to_xml(xml_element)
+            
+    def write_xml(self, xml_stream):
+        if len(self.children) == 0:
+            xml_stream.leaf(self.TAG, self.attrib)
+            return
+        with xml_stream.element(self.TAG, self.attrib):
+            for child in self.children:
+                child.write_xml(xml_stream)
+
+class SimpleCondition(ConnectorPart):
+    __slots__ = ()
+    TAG = 'simpleCondition'
+    
+    def __init__(self, role, delay=None, eventType=None, key=None, transition=None, 
+                 min=None, max=None, qualifier=None):
+        ConnectorPart.__init__(self, {'role': role, 'delay': delay, 'eventType': eventType, 
+                                      'key': key, 'transition': transition, 'min': min, 
+                                      'max': max, 'qualifier': qualifier})
+
+class AttributeAssessment(ConnectorPart):
+    __slots__ = ()
+    TAG = 'attributeAssessment'
+    
+    def __init__(self, role, eventType=None, key=None, attributeType=None, offset=None):
+        ConnectorPart.__init__(self, {'role': role, 'eventType': eventType, 'key': key, 
+                                      'attributeType': attributeType, 'offset': offset})
+
+class ValueAssessment(ConnectorPart):
+    __slots__ = ()
+    TAG = 'valueAssessment'
+    
+    def __init__(self, value):
+        ConnectorPart.__init__(self, {'value': value})
+
+class AssessmentStatement(ConnectorPart):
+    __slots__ = ()
+    TAG = 'assessmentStatement'
+    __comparators = ['eq', 'ne', 'gt', 'lt', 'gte', 'lte']
+    
+    def __init__(self, comparator, attribute, value):
+        if comparator not in self.__comparators:
+            raise ValueError('The comparator argument must assume the following values: ' + \
+                             str(self.__comparators))
+        if not isinstance(attribute, AttributeAssessment):
+            raise TypeError('The attribute argument must be an instance of AttributeAssessment')
+        if not isinstance(value, (AttributeAssessment, ValueAssessment)):
+            value = ValueAssessment(value)
+        ConnectorPart.__init__(self, {'comparator': comparator}, (attribute, value))
+
+class CompoundStatement(ConnectorPart):
+    __slots__ = ()
+    TAG = 'compoundStatement'
+    __operators = ['and', 'or']
+    
+    def __init__(self, operator, statements, isNegated=None):
+        if operator not in self.__operators:
+            raise ValueError('The operator argument must assume the following values: ' + \
+                             str(self.__operators))
+        ConnectorPart.check(statements, (AssessmentStatement, CompoundStatement), 'statements')
+        if isNegated != None:
+            isNegated = str(isNegated).lower()
+        ConnectorPart.__init__(self, {'operator': operator, 'isNegated': isNegated}, 
+                               statements)
+
+class CompoundCondition(ConnectorPart):
+    __slots__ = ()
+    TAG = 'compoundCondition'
+    __operators = ['and', 'or']
+    
+    def __init__(self, operator, conditions, delay=None):
+        if operator not in self.__operators:
+            raise ValueError('The operator argument must assume the following values: ' + \
+                             str(self.__operators))
+        ConnectorPart.check(conditions, (SimpleCondition, CompoundCondition, 
+                                         AssessmentStatement, CompoundStatement), 'conditions')
+        ConnectorPart.__init__(self, {'operator': operator, 'delay': delay}, conditions)
+
+class SimpleAction(ConnectorPart):
+    __slots__ = ()
+    TAG = 'simpleAction'
+    
+    def __init__(self, role, delay=None, eventType=None, actionType=None, value=None, 
+                 min=None, max=None, qualifier=None, repeat=None, repeatDelay=None, 
+                 duration=None, by=None):
+        ConnectorPart.__init__(self, {'role': role, 'delay': delay, 'eventType': eventType, 
+                                      'actionType': actionType, 'value': value, 'min': min, 
+                                      'max': max, 'qualifier': qualifier, 'repeat': repeat, 
+                                      'repeatDelay': repeatDelay, 'duration': duration, 
+                                      'by': by})
+
+class CompoundAction(ConnectorPart):
+    __slots__ = ()
+    TAG = 'compoundAction'
+    __operators = ['par', 'seq']
+    
+    def __init__(self, operator, actions, delay=None):
+        if operator not in self.__operators:
+            raise ValueError('The operator argument must assume the following values: ' + \
+                             str(self.__operators))
+        ConnectorPart.check(actions, (SimpleAction, CompoundAction), 'actions')
+        ConnectorPart.__init__(self, {'operator': operator, 'delay': delay}, actions)
 
 class Connector(NclEntity):
-    pass
+    # A causalConnector. condition, action and params (name to type) are
+    # fixed at construction, where the roles and the structural key are
+    # computed. Connectors with the same key only differ in their id, see
+    # intern() and NclDocument.add_connector.
+    
+    def __init__(self, mid, condition, action, params=None):
+        NclEntity.__init__(self, mid)
+        if not isinstance(condition, (SimpleCondition, CompoundCondition)):
+            raise TypeError('The condition argument must be an instance of ' + 
+                            'SimpleCondition or CompoundCondition')
+        if not isinstance(action, (SimpleAction, CompoundAction)):
+            raise TypeError('The action argument must be an instance of ' + 
+                            'SimpleAction or CompoundAction')
+        self.__condition = condition
+        self.__action = action
+        self.__params = dict(params or {})
+        self.__roles = condition.roles | action.roles
+        self.key = Connector.structure_key(condition, action, self.__params)
+        
+    @staticmethod
+    def structure_key(condition, action, params=None):
+        params = tuple(sorted((params or {}).items(), key=lambda item: item[0]))
+        return (condition.key, action.key, params)
+    
+    @staticmethod
+    def intern(mid, condition, action, params=None):
+        # One shared instance per structure in the active registry, which
+        # drops them with its other entities. Whichever generator asks for
+        # it first gives the id; the ids asked for later become aliases of
+        # it, so links can still name them. It still has to be added to each
+        # document with NclDocument.add_connector.
+        registry = current_registry()
+        key = Connector.structure_key(condition, action, params)
+        connector = registry.interned_connectors.get(key)
+        if connector == None:
+            connector = registry.interned_connectors[key] = Connector(mid, condition, action, 
+                                                                      params)
+        elif mid != None and registry.get(mid) is not connector:
+            registry.alias(mid, connector)
+        return connector
+        
+    def get_condition(self):
+        return self.__condition
+    
+    def get_action(self):
+        return self.__action
+    
+    def get_params(self):
+        return self.__params
+    
+    def get_roles(self):
+        return self.__roles
+    
+    def xml_attrib(self):
+        return {'id': self.id}
+    
+    def to_xml(self, parent_node):
+        xml_connector = ET.SubElement(parent_node, 'causalConnector', self.xml_attrib())
+        for name, param_type in self.__params.items():
+            ET.SubElement(xml_connector, 'connectorParam', self.param_attrib(name, param_type))
+        self.__condition.to_xml(xml_connector)
+        self.__action.to_xml(xml_connector)
+        
+    def write_xml(self, xml_stream):
+        with xml_stream.element('causalConnector', self.xml_attrib()):
+            for name, param_type in self.__params.items():
+                xml_stream.leaf('connectorParam', self.param_attrib(name, param_type))
+            self.__condition.write_xml(xml_stream)
+            self.__action.write_xml(xml_stream)
+            
+    @staticmethod
+    def param_attrib(name, param_type):
+        attrib = {'name': name}
+        if param_type != None:
+            attrib['type'] = param_type
+        return attrib
 
 class Transition(NclEntity):
     pass
 
 class Node(NclEntity):
+    # The context holding this node and the cached output of to_bytes and
+    # xml_size. Any change made through the add_* methods or by assigning an
+    # attribute drops the caches of the node and of every context above it.
+    # Anchors are not watched: call touch() after changing one in place.
+    parent = None
+    xml_cache = None
+    size_cache = None
+    UNTRACKED = ('parent', 'xml_cache', 'size_cache')
+    
     def __init__(self, mid):
         NclEntity.__init__(self, mid)
-        self.__anchors = []
+        # Allocated with the first anchor, most nodes never get one
+        self.__anchors = None
+        
+    def __setattr__(self, name, value):
+        track_reference(self, name, value)
+        NclEntity.__setattr__(self, name, value)
+        if name not in Node.UNTRACKED:
+            self.touch()
+            
+    def touch(self):
+        node = self
+        while node != None and (node.xml_cache != None or node.size_cache != None):
+            node.xml_cache = None
+            node.size_cache = None
+            node = node.parent
+    
+    def to_bytes(self, depth=0, encoding=None, compact=False):
+        key = (depth, encoding, compact)
+        if self.xml_cache == None or self.xml_cache[0] != key:
+            self.xml_cache = (key, self.build_bytes(depth, encoding, compact))
+        return self.xml_cache[1]
+    
+    def build_bytes(self, depth, encoding=None, compact=False):
+        output = BytesIO()
+        xml_stream = XmlTextStream(output, encoding, depth, compact)
+        self.write_xml(xml_stream)
+        xml_stream.flush()
+        return output.getvalue()
+    
+    def xml_size(self, depth=0, encoding=None, compact=False):
+        # Exact length of to_bytes(depth, encoding, compact), without keeping
+        # the bytes. Contexts add up the cached sizes of their children.
+        key = (depth, encoding, compact)
+        if self.xml_cache != None and self.xml_cache[0] == key:
+            return len(self.xml_cache[1])
+        if self.size_cache == None or self.size_cache[0] != key:
+            self.size_cache = (key, self.count_bytes(depth, encoding, compact))
+        return self.size_cache[1]
+    
+    def count_bytes(self, depth, encoding=None, compact=False):
+        output = ByteCounter()
+        xml_stream = XmlTextStream(output, encoding, depth, compact)
+        self.write_xml(xml_stream)
+        xml_stream.flush()
+        return output.size
+    
+    def clone(self, id_mapper, share_anchors=False):
+        return NodeCloner(id_mapper, share_anchors).clone(self)
     
     def add_anchor(self, anchor):
         if not isinstance(anchor, Anchor):
             raise TypeError('The argument must be an instance of Anchor    ')
+        if self.__anchors == None:
+            self.__anchors = []
         self.__anchors.append(anchor)
+        self.touch()
+        
+    def remove_anchor(self, anchor):
+        self.__anchors.remove(anchor)
+        self.touch()
         
     def get_anchors(self):
+        if self.__anchors == None:
+            return []
         return self.__anchors
 
 class Context(Node):
+    REFERENCES = ('refer',)
+    
     def __init__(self, mid, is_body=None, refer=None):
         Node.__init__(self, mid)
         self.is_body = is_body
         if refer == None:
             self.refer = None
         elif isinstance(refer, str):
-            self.refer = NclEntity.IDS[refer]
+            self.refer = NclEntity.IDS.reference(self, 'refer', refer, Context)
         elif isinstance(refer, Context):
             self.refer = refer
         else:
@@ -331,28 +1568,56 @@ class Context(Node):
         if not isinstance(node, Node):
             raise TypeError('The argument must be an instance of Node')
         self.__nodes.append(node)
+        node.parent = self
+        self.touch()
+        
+    def remove_node(self, node):
+        self.__nodes.remove(node)
+        node.parent = None
+        self.touch()
         
     def add_link(self, link):
         if not isinstance(link, Link):
             raise TypeError('The argument must be an instance of Link')
         self.__links.append(link)
+        link.parent = self
+        self.touch()
+        
+    def remove_link(self, link):
+        self.__links.remove(link)
+        link.parent = None
+        self.touch()
         
     def add_anchor(self, anchor):
         if not isinstance(anchor, Port) and not isinstance(anchor, NodeProperty):
             raise TypeError('The argument must be an instance of Port or NodeProperty')
         Node.add_anchor(self, anchor)
+        if isinstance(anchor, Port):
+            anchor.parent = self
         
-    def to_xml(self, xml_root):
-        xml_context = None
+    def get_nodes(self):
+        return self.__nodes
+    
+    def get_links(self):
+        return self.__links
+        
+    def xml_tag_attrib(self):
+        attrib = {}
         if self.is_body == True:
-            xml_context = ET.SubElement(xml_root, 'body')
+            tag = 'body'
             if self.id != None:
-                xml_context.attrib['id'] = self.id
+                attrib['id'] = self.id
         else:
-            xml_context = ET.SubElement(xml_root, 'context', id=self.id)
+            tag = 'context'
+            attrib['id'] = self.id
             
         if self.refer != None:
-            xml_context.attrib['refer'] = self.refer.id     
+            attrib['refer'] = self.refer.id
+        return tag, attrib
+        
+    def to_xml(self, xml_root):
+        tag, attrib = self.xml_tag_attrib()
+        xml_context = ET.SubElement(xml_root, tag, attrib)
             
         for anchor in self.get_anchors():
             anchor.to_xml(xml_context)
@@ -362,8 +1627,51 @@ class Context(Node):
     
         for link in self.__links:
             link.to_xml(xml_context)
+            
+    def write_xml(self, xml_stream):
+        tag, attrib = self.xml_tag_attrib()
+        with xml_stream.element(tag, attrib):
+            for anchor in self.get_anchors():
+                anchor.write_xml(xml_stream)
+                
+            for node in self.__nodes:
+                node.write_xml(xml_stream)
+        
+            for link in self.__links:
+                link.write_xml(xml_stream)
+                
+    def build_bytes(self, depth, encoding=None, compact=False):
+        output = BytesIO()
+        self.__write_text(output, depth, encoding, compact, 
+                          lambda node: node.to_bytes(depth + 1, encoding, compact))
+        return output.getvalue()
+    
+    def count_bytes(self, depth, encoding=None, compact=False):
+        # Children are written empty and counted with their own xml_size
+        output = ByteCounter()
+        
+        def node_bytes(node):
+            output.size += node.xml_size(depth + 1, encoding, compact)
+            return b''
+        self.__write_text(output, depth, encoding, compact, node_bytes)
+        return output.size
+    
+    def __write_text(self, output, depth, encoding, compact, node_bytes):
+        xml_stream = XmlTextStream(output, encoding, depth, compact)
+        tag, attrib = self.xml_tag_attrib()
+        with xml_stream.element(tag, attrib):
+            for anchor in self.get_anchors():
+                anchor.write_xml(xml_stream)
+                
+            for node in self.__nodes:
+                xml_stream.raw(node_bytes(node))
+        
+            for link in self.__links:
+                link.write_xml(xml_stream)
+        xml_stream.flush()
 
 class Media(Node):
+    REFERENCES = ('descriptor', 'refer')
     __instance_types = ['new', 'instSame', 'gradSame']
         
     def __init__(self, mid=None, src=None, mtype=None, refer=None, instance=None, descriptor=None):
@@ -373,7 +1681,7 @@ class Media(Node):
         if refer == None:
             self.refer = None
         elif isinstance(refer, str):
-            self.refer = NclEntity.IDS[refer]
+            self.refer = NclEntity.IDS.reference(self, 'refer', refer, Media)
         elif isinstance(refer, Media):
             self.refer = refer
         else:
@@ -387,7 +1695,8 @@ class Media(Node):
         if descriptor == None:
             self.descriptor = None
         elif isinstance(descriptor, str):
-            self.descriptor = NclEntity.IDS[descriptor]
+            self.descriptor = NclEntity.IDS.reference(self, 'descriptor', descriptor, 
+                                                      Descriptor)
         elif isinstance(descriptor, Descriptor):
             self.descriptor = descriptor
         else:
@@ -399,35 +1708,56 @@ class Media(Node):
             raise TypeError('The argument must be an instance of Area or NodeProperty')
         Node.add_anchor(self, anchor)      
         
-    def to_xml(self, parent_node):
-        xml_media = ET.SubElement(parent_node, 'media')
-        xml_media.attrib['id'] = self.id
+    def add_areas(self, ids_or_prefix, begin, end=None, start=0):
+        # Bulk form of add_anchor(Area(mid, begin=..., end=...)). ids_or_prefix
+        # is either one id per area or a prefix numbered from start on.
+        area_block = AreaBlock(ids_or_prefix, begin, end, start)
+        Node.add_anchor(self, area_block)
+        return area_block
         
+    def xml_attrib(self):
+        attrib = {'id': self.id}
         if self.type != None:
-            xml_media.attrib['type'] = self.type
+            attrib['type'] = self.type
         if self.src != None:
-            xml_media.attrib['src'] = self.src
+            attrib['src'] = self.src
         if self.refer != None:
-            xml_media.attrib['refer'] = self.refer.id
+            attrib['refer'] = self.refer.id
         if self.instance != None:
-            xml_media.attrib['instance'] = self.instance
+            attrib['instance'] = self.instance
         if self.descriptor != None:
-            xml_media.attrib['descriptor'] = self.descriptor.id
+            attrib['descriptor'] = self.descriptor.id
+        return attrib
+        
+    def to_xml(self, parent_node):
+        xml_media = ET.SubElement(parent_node, 'media', self.xml_attrib())
             
         for anchor in self.get_anchors():
             anchor.to_xml(xml_media)
+            
+    def write_xml(self, xml_stream):
+        with xml_stream.element('media', self.xml_attrib()):
+            for anchor in self.get_anchors():
+                anchor.write_xml(xml_stream)
+                
         
 
 class Anchor(NclEntity):
+    __slots__ = ()
+    
     def __init__(self, mid, missing_id=None):
         NclEntity.__init__(self, mid, missing_id)
 
 class Port(Anchor):
+    REFERENCES = ('component', 'interface')
+    # The context holding the port
+    parent = None
+    
     def __init__(self, mid, component, interface=None):
         NclEntity.__init__(self, mid)
         
         if isinstance(component, str):
-            self.component = NclEntity.IDS[component]
+            self.component = NclEntity.IDS.reference(self, 'component', component, Node)
         elif isinstance(component, Node):
             self.component = component
         else:
@@ -436,23 +1766,36 @@ class Port(Anchor):
         if interface == None:
             self.interface = None
         elif isinstance(interface, str):
-            self.interface = NclEntity.IDS[interface]
+            self.interface = NclEntity.IDS.reference(self, 'interface', interface, Anchor)
         elif isinstance(interface, Anchor):
             self.interface = interface
         else:
             raise TypeError('The interface argument must be an instance ' + \
                             'of Anchor or the id of a valid Anchor instance')
             
-    def to_xml(self, parent_node):
-        xml_context = ET.SubElement(parent_node, 'port')
+    def __setattr__(self, name, value):
+        track_reference(self, name, value)
+        NclEntity.__setattr__(self, name, value)
+        
+    def xml_attrib(self):
+        attrib = {}
         if self.id != None:
-            xml_context.attrib['id'] = self.id
+            attrib['id'] = self.id
         if self.component != None:
-            xml_context.attrib['component'] = self.component.id
+            attrib['component'] = self.component.id
         if self.interface != None:
-            xml_context.attrib['interface'] = self.interface.id
+            attrib['interface'] = self.interface.id
+        return attrib
+            
+    def to_xml(self, parent_node):
+        ET.SubElement(parent_node, 'port', self.xml_attrib())
+        
+    def write_xml(self, xml_stream):
+        xml_stream.leaf('port', self.xml_attrib())
 
 class NodeProperty(Anchor):
+    __slots__ = ('name', 'value', 'externable')
+    
     def __init__(self, name, value=None, externable=None):
         Anchor.__init__(self, None, True)
         self.name = name
@@ -461,17 +1804,39 @@ class NodeProperty(Anchor):
             raise TypeError('The externable argument must be a bool')
         self.externable = externable
         
-    def to_xml(self, parent_node):
-        xml_media = ET.SubElement(parent_node, 'property')
-        xml_media.attrib['name'] = self.name
+    @staticmethod
+    def intern(name, value=None, externable=None):
+        # Flyweight for the same name/value pair repeated over many nodes.
+        # The returned instance is shared, so it must not be modified. It is
+        # kept by the active registry, which drops it with its other entities.
+        properties = current_registry().interned_properties
+        key = (name, value, externable)
+        node_property = properties.get(key)
+        if node_property == None:
+            node_property = properties.setdefault(key, 
+                                NodeProperty(name, value, externable))
+        return node_property
+        
+    def xml_attrib(self):
+        attrib = {'name': self.name}
         
         if self.value != None:
-            xml_media.attrib['value'] = self.value
+            attrib['value'] = self.value
         if self.externable != None:
-            xml_media.attrib['externable'] = str(self.externable).lower()
+            attrib['externable'] = str(self.externable).lower()
+        return attrib
+        
+    def to_xml(self, parent_node):
+        ET.SubElement(parent_node, 'property', self.xml_attrib())
+        
+    def write_xml(self, xml_stream):
+        xml_stream.leaf('property', self.xml_attrib())
         
 
 class Area(Anchor):
+    __slots__ = ('coords', 'begin', 'end', 'beginText', 'endText', 'beginPosition',
+                 'endPosition', 'first', 'last', 'label', 'clip')
+    
     def __init__(self, mid, coords=None, begin=None, end=None, beginText=None, 
                  endText=None, beginPosition=None, endPosition=None, first=None, 
                  last=None, label=None, clip=None):
@@ -491,55 +1856,153 @@ class Area(Anchor):
         self.label = label
         self.clip = clip
         
-    def to_xml(self, parent_node):
-        xml_media = ET.SubElement(parent_node, 'area')
-        xml_media.attrib['id'] = self.id
+    def xml_attrib(self):
+        attrib = {'id': self.id}
         
         #TODO More meaningful values for coords, first and last
         if self.coords != None:
-            xml_media.attrib['coords'] = self.coords
+            attrib['coords'] = self.coords
         if self.begin != None:
-            if isinstance(self.begin, str):
-                xml_media.attrib['begin'] = self.begin
-            else:
-                xml_media.attrib['begin'] = str(self.begin) + 's'
+            attrib['begin'] = Area.format_time(self.begin)
         if self.end != None:
-            if isinstance(self.end, str):
-                xml_media.attrib['end'] = self.end
-            else:
-                xml_media.attrib['end'] = str(self.end) + 's'
+            attrib['end'] = Area.format_time(self.end)
         if self.beginText != None:
-            xml_media.attrib['beginText'] = self.beginText
+            attrib['beginText'] = self.beginText
         if self.endText != None:
-            xml_media.attrib['endText'] = str(self.endText)
+            attrib['endText'] = str(self.endText)
         if self.beginPosition != None:
-            xml_media.attrib['beginPosition'] = str(self.beginPosition)
+            attrib['beginPosition'] = str(self.beginPosition)
         if self.endPosition != None:
-            xml_media.attrib['endPosition'] = str(self.endPosition)
+            attrib['endPosition'] = str(self.endPosition)
         if self.first != None:
-            xml_media.attrib['first'] = self.first
+            attrib['first'] = self.first
         if self.last != None:
-            xml_media.attrib['last'] = self.last
+            attrib['last'] = self.last
         if self.label != None:
-            xml_media.attrib['label'] = self.label
+            attrib['label'] = self.label
         if self.clip != None:
-            xml_media.attrib['clip'] = self.clip
-
-class Link(NclEntity):
-    def __init__(self, xconnector, mid=None):
-        missing_id = False
-        if mid == None:
-            missing_id = True
+            attrib['clip'] = self.clip
+        return attrib
+    
+    def to_xml(self, parent_node):
+        ET.SubElement(parent_node, 'area', self.xml_attrib())
+        
+    def write_xml(self, xml_stream):
+        xml_stream.leaf('area', self.xml_attrib())
             
-        NclEntity.__init__(self, mid, missing_id)
+    @staticmethod
+    def format_time(value):
+        if isinstance(value, str):
+            return value
+        return str(value) + 's'
+    
+    @staticmethod
+    def parse_time(value):
+        # Seconds for '12.5s', '12.5', 'hh:mm:ss.f' or a number, None for
+        # anything else (for instance 'indefinite' or a sample count)
+        if value is None:
+            return None
+        if not isinstance(value, str):
+            return float(value)
+        try:
+            if value.endswith('s'):
+                return float(value[:-1])
+            seconds = 0.0
+            for part in value.split(':'):
+                seconds = seconds * 60 + float(part)
+            return seconds
+        except ValueError:
+            return None
+    
+class AreaBlock(Anchor):
+    # Temporal areas stored column-wise, as added by Media.add_areas. The
+    # begin and end columns are kept as given (a NumPy array stays a NumPy
+    # array) and no Area object is kept: each area only exists as an
+    # <area> element in the output. The ids are kept unique through the
+    # registry, which hands out a transient Area from get_area when one of
+    # them is looked up.
+    __slots__ = ('ids', 'start', 'begin', 'end', 'count')
+    
+    def __init__(self, ids, begin, end=None, start=0):
+        Anchor.__init__(self, None)
+        self.count = len(begin)
+        if isinstance(ids, str):
+            self.ids = ids
+        else:
+            self.ids = list(ids)
+            if len(self.ids) != self.count:
+                raise ValueError('The ids and begin arguments must have the same length')
+        if end is not None and len(end) != self.count:
+            raise ValueError('The begin and end arguments must have the same length')
+        self.start = start
+        self.begin = begin
+        self.end = end
         
-        self.__use_alias = False
+        current_registry().register_block(self)
+        
+    def get_area(self, index):
+        # An unregistered Area for the index-th area of the block
+        area = object.__new__(Area)
+        for name in Area.__slots__:
+            object.__setattr__(area, name, None)
+        if isinstance(self.ids, str):
+            area.id = '%s%d' % (self.ids, self.start + index)
+        else:
+            area.id = self.ids[index]
+        area.missing_id = None
+        area.begin = self.begin[index]
+        if self.end is not None:
+            area.end = self.end[index]
+        return area
+        
+    def get_ids(self):
+        if isinstance(self.ids, str):
+            return ['%s%d' % (self.ids, index) 
+                    for index in range(self.start, self.start + self.count)]
+        return self.ids
+    
+    def __len__(self):
+        return self.count
+    
+    def __iter__(self):
+        if self.end is None:
+            return zip(self.get_ids(), self.begin, [None] * self.count)
+        return zip(self.get_ids(), self.begin, self.end)
+        
+    def __xml_attrib(self, mid, begin, end):
+        attrib = {'id': mid, 'begin': Area.format_time(begin)}
+        if end != None:
+            attrib['end'] = Area.format_time(end)
+        return attrib
+    
+    def to_xml(self, parent_node):
+        for mid, begin, end in self:
+            ET.SubElement(parent_node, 'area', self.__xml_attrib(mid, begin, end))
+            
+    def write_xml(self, xml_stream):
+        for mid, begin, end in self:
+            xml_stream.leaf('area', self.__xml_attrib(mid, begin, end))
+
+class Link(NclEntity):
+    # The context holding the link, whose cached output it drops on change
+    parent = None
+    REFERENCES = ('_Link__xconnector',)
+    
+    def __init__(self, xconnector, mid=None):
+        missing_id = False
+        if mid == None:
+            missing_id = True
+            
+        NclEntity.__init__(self, mid, missing_id)
+        
+        self.__use_alias = False
         if isinstance(xconnector, str):
             if xconnector.count('#'):
                 self.__use_alias = True
                 self.__xconnector = xconnector
             else:
-                self.__xconnector = NclEntity.IDS[xconnector]
+                self.__xconnector = NclEntity.IDS.reference(self, '_Link__xconnector', 
+                                                            xconnector, Connector)
         elif isinstance(xconnector, Connector):
             self.__xconnector = xconnector
         else:
@@ -553,32 +2016,82 @@ class Link(NclEntity):
         if not isinstance(bind, Bind):
             raise TypeError('The argument must be an instance of Bind')
         self.__binds.append(bind)
+        bind.link = self
+        self.touch()
+        
+    def remove_bind(self, bind):
+        self.__binds.remove(bind)
+        bind.link = None
+        self.touch()
     
     def add_param(self, name, value):
         self.__params[name] = value
+        self.touch()
         
-    def to_xml(self, parent_node):
-        xml_link = ET.SubElement(parent_node, 'link')
+    def __setattr__(self, name, value):
+        track_reference(self, name, value)
+        NclEntity.__setattr__(self, name, value)
+        if name != 'parent':
+            self.touch()
+            
+    def touch(self):
+        if self.parent != None:
+            self.parent.touch()
+        
+    def get_binds(self):
+        return self.__binds
+    
+    def get_params(self):
+        return self.__params
+    
+    def get_xconnector(self):
+        # The Connector, or the 'alias#id' string of an imported one
+        return self.__xconnector
+    
+    def set_xconnector(self, connector):
+        if not isinstance(connector, Connector):
+            raise TypeError('The argument must be an instance of Connector')
+        self.__use_alias = False
+        self.__xconnector = connector
+    
+    def xml_attrib(self):
         if self.__use_alias:
-            xml_link.attrib['xconnector'] = self.__xconnector
+            attrib = {'xconnector': self.__xconnector}
         else:
-            xml_link.attrib['xconnector'] = self.__xconnector.id
+            attrib = {'xconnector': self.__xconnector.id}
             
         if not self.missing_id:
-            xml_link.attrib['id'] = self.id
+            attrib['id'] = self.id
+        return attrib
+        
+    def to_xml(self, parent_node):
+        xml_link = ET.SubElement(parent_node, 'link', self.xml_attrib())
         
         for n, v in self.__params.items():
             ET.SubElement(xml_link, 'linkParam', name=n, value=v)
             
         for bind in self.__binds:
             bind.to_xml(xml_link)
+            
+    def write_xml(self, xml_stream):
+        with xml_stream.element('link', self.xml_attrib()):
+            for n, v in self.__params.items():
+                xml_stream.leaf('linkParam', {'name': n, 'value': v})
+                
+            for bind in self.__binds:
+                bind.write_xml(xml_stream)
         
 class Bind():
+    # The link holding the bind, passed on changes like Link.parent
+    link = None
+    REFERENCES = ('component', 'interface', 'descriptor')
+    
     def __init__(self, role, component, interface=None, descriptor=None):
+        object.__setattr__(self, 'registry', current_registry())
         self.role = role
         
         if isinstance(component, str):
-            self.component = NclEntity.IDS[component]
+            self.component = NclEntity.IDS.reference(self, 'component', component, Node)
         elif isinstance(component, Node):
             self.component = component
         else:
@@ -600,7 +2113,8 @@ class Bind():
         if descriptor == None:
             self.descriptor = None
         elif isinstance(descriptor, str):
-            self.descriptor = NclEntity.IDS[descriptor]
+            self.descriptor = NclEntity.IDS.reference(self, 'descriptor', descriptor, 
+                                                      Descriptor)
         elif isinstance(descriptor, Descriptor):
             self.descriptor = descriptor
         else:
@@ -612,19 +2126,2247 @@ class Bind():
         
     def add_param(self, name, value):
         self.__params[name] = value
+        self.touch()
+        
+    def __setattr__(self, name, value):
+        track_reference(self, name, value)
+        object.__setattr__(self, name, value)
+        if name != 'link':
+            self.touch()
+            
+    def touch(self):
+        if self.link != None:
+            self.link.touch()
     
-    def to_xml(self, xml_link):
-        xml_bind = ET.SubElement(xml_link, 'bind', role=self.role)
-        xml_bind.attrib['component'] = self.component.id
+    def get_params(self):
+        return self.__params
+    
+    def xml_attrib(self):
+        attrib = {'role': self.role, 'component': self.component.id}
         if self.interface != None:
-            xml_bind.attrib['interface'] = self.interface
+            attrib['interface'] = self.interface
         if self.descriptor != None:
-            xml_bind.attrib['descriptor'] = self.descriptor.id
+            attrib['descriptor'] = self.descriptor.id
+        return attrib
+    
+    def to_xml(self, xml_link):
+        xml_bind = ET.SubElement(xml_link, 'bind', self.xml_attrib())
             
         for n, v in self.__params.items():
             ET.SubElement(xml_bind, 'bindParam', name=n, value=v)
+            
+    def write_xml(self, xml_stream):
+        with xml_stream.element('bind', self.xml_attrib()):
+            for n, v in self.__params.items():
+                xml_stream.leaf('bindParam', {'name': n, 'value': v})
+    
+            
+class NodeCloner:
+    # Copies a node subtree in one walk, without the constructor checks.
+    # id_mapper gives the id of the copy of every entity with an id; links
+    # and properties without one get a generated id. References between
+    # entities of the subtree (refer, the component and interface of ports
+    # and binds) are rewritten to the copies, references leaving it, like
+    # descriptors and connectors, are kept. Every copy gets an id of its
+    # own, AreaBlocks included, but the begin and end columns of AreaBlocks
+    # are shared. With share_anchors, each run of areas of a media that only
+    # have an id, begin and end is copied as an AreaBlock instead, and the
+    # clones of the same media share its begin and end columns as long as
+    # the areas keep their times.
+    __slot_names = {}
+    __columns = WeakKeyDictionary()
+    
+    def __init__(self, id_mapper, share_anchors=False):
+        if not callable(id_mapper):
+            raise TypeError('The id_mapper argument must be callable')
+        self.id_mapper = id_mapper
+        self.share_anchors = share_anchors
+        self.registry = current_registry()
+        self.__copies = {}
+        self.__block_areas = {}
+        self.__ids = {}
+        self.__blocks = []
+        self.__referrers = []
+        
+    def clone(self, node):
+        self.registry.resolve()
+        copy = self.__node(node)
+        references = self.registry.references
+        for referrer in self.__referrers:
+            for name in referrer.REFERENCES:
+                value = getattr(referrer, name, None)
+                if value == None:
+                    continue
+                if isinstance(value, str):
+                    value = self.__interface_id(value)
+                elif value in self.__block_areas:
+                    block, index = self.__block_areas[value]
+                    value = block.get_area(index)
+                else:
+                    value = self.__copies.get(value, value)
+                object.__setattr__(referrer, name, value)
+                references.add(referrer, value)
+        return copy
+    
+    def __copy(self, entity):
+        # Shallow copy with a new id, registered
+        cls = type(entity)
+        copy = object.__new__(cls)
+        if hasattr(entity, '__dict__'):
+            copy.__dict__.update(entity.__dict__)
+        names = NodeCloner.__slot_names.get(cls)
+        if names == None:
+            names = [name for klass in cls.__mro__ for name in getattr(klass, '__slots__', ()) 
+                     if name != '__weakref__']
+            NodeCloner.__slot_names[cls] = names
+        for name in names:
+            if hasattr(entity, name):
+                object.__setattr__(copy, name, getattr(entity, name))
+        
+        if getattr(entity, 'missing_id', None) == True:
+            mid = NclEntity.generate_id(cls.__name__)
+        elif entity.id != None:
+            mid = self.id_mapper(entity.id)
+            self.__ids[entity.id] = mid
+        else:
+            mid = None
+        object.__setattr__(copy, 'id', mid)
+        object.__setattr__(copy, 'registry', self.registry)
+        if mid != None:
+            self.registry.register(copy)
+        self.__copies[entity] = copy
+        return copy
+    
+    def __node(self, node):
+        copy = self.__copy(node)
+        for name in Node.UNTRACKED:
+            copy.__dict__.pop(name, None)
+        self.__referrers.append(copy)
+        
+        anchors = node.get_anchors()
+        if len(anchors) == 0:
+            copy.__dict__['_Node__anchors'] = None
+        elif self.share_anchors and isinstance(node, Media):
+            copy.__dict__['_Node__anchors'] = self.__media_anchors(node, copy)
+        else:
+            copy.__dict__['_Node__anchors'] = [self.__anchor(anchor, copy) for anchor in anchors]
+        
+        if isinstance(node, Context):
+            nodes = []
+            for child in node.get_nodes():
+                child_copy = self.__node(child)
+                child_copy.__dict__['parent'] = copy
+                nodes.append(child_copy)
+            copy.__dict__['_Context__nodes'] = nodes
+            copy.__dict__['_Context__links'] = [self.__link(link, copy) 
+                                                for link in node.get_links()]
+        return copy
+    
+    def __anchor(self, anchor, parent):
+        copy = self.__copy(anchor)
+        if isinstance(anchor, Port):
+            copy.__dict__['parent'] = parent
+            self.__referrers.append(copy)
+        elif isinstance(anchor, AreaBlock):
+            if isinstance(anchor.ids, str):
+                object.__setattr__(copy, 'ids', self.id_mapper(anchor.ids))
+                self.__blocks.append((anchor, copy))
+            else:
+                ids = [self.id_mapper(mid) for mid in anchor.ids]
+                self.__ids.update(zip(anchor.ids, ids))
+                object.__setattr__(copy, 'ids', ids)
+            self.registry.register_block(copy)
+        return copy
+    
+    @staticmethod
+    def plain_area(anchor):
+        if type(anchor) is not Area or anchor.begin == None:
+            return False
+        for name in Area.__slots__:
+            if name not in ('begin', 'end') and getattr(anchor, name) != None:
+                return False
+        return True
+    
+    def __media_anchors(self, media, copy):
+        known = NodeCloner.__columns.get(media, [])
+        columns = []
+        anchors = []
+        run = []
+        for anchor in media.get_anchors() + [None]:
+            if anchor != None and NodeCloner.plain_area(anchor):
+                run.append(anchor)
+                continue
+            if len(run) > 0:
+                cached = known[len(columns)] if len(columns) < len(known) else None
+                columns.append(self.__area_block(run, cached))
+                anchors.append(columns[-1][2])
+                run = []
+            if anchor != None:
+                anchors.append(self.__anchor(anchor, copy))
+        NodeCloner.__columns[media] = [(begin, end) for begin, end, block in columns]
+        return anchors
+    
+    def __area_block(self, areas, cached):
+        # Returns (begin, end, block), with the columns of the previous
+        # clone when they are still equal
+        begin = tuple([area.begin for area in areas])
+        end = tuple([area.end for area in areas])
+        if end.count(None) == len(end):
+            end = None
+        if cached != None and cached == (begin, end):
+            begin, end = cached
+        block = object.__new__(AreaBlock)
+        for name, value in (('id', None), ('missing_id', None), ('registry', self.registry), 
+                            ('ids', [self.id_mapper(area.id) for area in areas]), 
+                            ('start', 0), ('begin', begin), ('end', end), 
+                            ('count', len(areas))):
+            object.__setattr__(block, name, value)
+        self.registry.register_block(block)
+        for index, area in enumerate(areas):
+            self.__ids[area.id] = block.ids[index]
+            self.__block_areas[area] = (block, index)
+        return begin, end, block
+    
+    def __link(self, link, parent):
+        copy = self.__copy(link)
+        copy.__dict__['parent'] = parent
+        self.__referrers.append(copy)
+        copy.__dict__['_Link__params'] = dict(link.get_params())
+        binds = []
+        for bind in link.get_binds():
+            bind_copy = object.__new__(Bind)
+            bind_copy.__dict__.update(bind.__dict__)
+            bind_copy.__dict__['_Bind__params'] = dict(bind.get_params())
+            bind_copy.__dict__['link'] = copy
+            bind_copy.__dict__['registry'] = self.registry
+            self.__referrers.append(bind_copy)
+            binds.append(bind_copy)
+        copy.__dict__['_Link__binds'] = binds
+        return copy
+    
+    def __interface_id(self, mid):
+        # New id of an anchor of the subtree referred to by its id, as binds
+        # do, including the numbered ids of AreaBlocks
+        new_id = self.__ids.get(mid)
+        if new_id != None:
+            return new_id
+        for block, copy in self.__blocks:
+            if mid.startswith(block.ids):
+                index = mid[len(block.ids):]
+                if index.isdigit() and block.start <= int(index) < block.start + block.count:
+                    return copy.ids + index
+        return mid
+    
+class NclTableBuilder:
+    # Builds media with their areas, and links, from the rows of a table
+    # (dicts, as given by read_csv or read_json_lines) through a mapping of
+    # NCL attributes to format strings over the columns, for instance:
+    #
+    #   {'context': {'id': 'module{module}'},
+    #    'media': {'id': 'video{video}', 'src': 'videos/{file}', 'descriptor': 'dVideo'},
+    #    'area': {'id': 'video{video}_slide_{slide}', 'begin': '{begin}'},
+    #    'link': {'xconnector': 'conn#onBeginStart',
+    #             'binds': [{'role': 'onBegin', 'component': 'video{video}', 
+    #                        'interface': 'video{video}_slide_{slide}'},
+    #                       {'role': 'start', 'component': 'slide{slide}'}]}}
+    #
+    # Consecutive rows with the same context id share a context, and those
+    # with the same media id share a media (a context or media coming back
+    # after another one is a ValueError); each row adds its area and its
+    # link. An empty value leaves the attribute unset, and a row with an
+    # empty area id or xconnector adds no area or link. The mapping is
+    # checked once against the columns of the first row, then entities are
+    # made without going through their constructors. batches() yields the
+    # nodes and links batch_size rows at a time, see NclDocument.dump_rows.
+    ATTRIBUTES = {'context': ('id',),
+                  'media': ('id', 'src', 'type', 'descriptor'),
+                  'area': ('id',) + Area.__slots__,
+                  'link': ('id', 'xconnector', 'binds', 'params'),
+                  'bind': ('role', 'component', 'interface', 'descriptor', 'params')}
+    REQUIRED = {'context': ('id',), 'media': ('id',), 'link': ('xconnector',), 
+                'bind': ('role', 'component')}
+    # Plain numbers in these columns are seconds and get an 's'
+    TIMES = ('begin', 'end')
+    NUMBER = re.compile(r'[0-9]+(\.[0-9]*)?|\.[0-9]+')
+    
+    def __init__(self, mapping, batch_size=1000):
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError('The batch_size argument must be a positive int')
+        self.batch_size = batch_size
+        self.registry = current_registry()
+        self.columns = set()
+        self.__checked = False
+        self.__connectors = {}
+        self.__descriptors = {}
+        # Binds waiting for the node of a later row, by its id, and the ids
+        # of the nodes already written and forgotten by release
+        self.__pending = {}
+        self.__released = set()
+        
+        for kind in mapping:
+            if kind not in ('context', 'media', 'area', 'link'):
+                raise ValueError('Unknown entity in the mapping: ' + str(kind))
+        if 'media' not in mapping:
+            raise ValueError('The mapping must have a media entry')
+        self.context = self.__compile('context', mapping.get('context'))
+        self.media = self.__compile('media', mapping['media'])
+        self.area = self.__compile('area', mapping.get('area'))
+        self.link = self.__compile('link', mapping.get('link'))
+        if self.link != None:
+            self.binds = [self.__compile('bind', bind) for bind in self.link.pop('binds', ())]
+            self.link_params = self.link.pop('params', {})
+        
+    def __compile(self, kind, attributes):
+        # attribute -> function of the row, params -> name -> function
+        if attributes == None:
+            return None
+        if not isinstance(attributes, dict):
+            raise TypeError('The %s mapping must be a dict' % kind)
+        for name in self.REQUIRED.get(kind, ()):
+            if name not in attributes:
+                raise ValueError('The %s mapping must have an entry for %s' % (kind, name))
+        compiled = {}
+        for name, template in attributes.items():
+            if name not in self.ATTRIBUTES[kind]:
+                raise ValueError('Unknown %s attribute in the mapping: %s' % (kind, name))
+            if name == 'binds':
+                if not isinstance(template, (list, tuple)):
+                    raise TypeError('The binds mapping must be a list of dicts')
+                compiled[name] = template
+            elif name == 'params':
+                if not isinstance(template, dict):
+                    raise TypeError('The params mapping must be a dict')
+                compiled[name] = dict([(param, self.__template(value)) 
+                                       for param, value in template.items()])
+            else:
+                compiled[name] = self.__template(template)
+        return compiled
+    
+    def __template(self, template):
+        if not isinstance(template, str):
+            raise TypeError('The mapping values must be format strings')
+        fields = [field for literal, field, spec, conversion in Formatter().parse(template) 
+                  if field != None]
+        for field in fields:
+            if field == '' or field.isdigit():
+                raise ValueError('The mapping fields must be column names: ' + template)
+        self.columns.update([field.split('.')[0].split('[')[0] for field in fields])
+        if len(fields) == 0:
+            return lambda row: template or None
+        if len(fields) == 1 and template == '{' + fields[0] + '}':
+            column = fields[0]
+            
+            def value(row):
+                value = row.get(column)
+                if value == None or value == '':
+                    return None
+                return str(value)
+            return value
+        return lambda row: template.format_map(row) or None
+    
+    @staticmethod
+    def read_csv(source, **fmtparams):
+        # Rows of a CSV file with a header line; source is a file name or a
+        # text file-like object
+        if hasattr(source, 'read'):
+            yield from csv.DictReader(source, **fmtparams)
+            return
+        with open(source, newline='') as csv_file:
+            yield from csv.DictReader(csv_file, **fmtparams)
+    
+    @staticmethod
+    def read_json_lines(source):
+        # Rows of a file with one JSON object per line
+        if not hasattr(source, 'read'):
+            with open(source) as json_file:
+                yield from NclTableBuilder.read_json_lines(json_file)
+            return
+        for line in source:
+            if line.strip() == '':
+                continue
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError('Each JSON line must hold an object: ' + line.strip())
+            yield row
+    
+    def check(self, row):
+        missing = sorted(self.columns.difference(row))
+        if len(missing) > 0:
+            raise ValueError('Columns missing from the rows: ' + ', '.join(missing))
+        self.__checked = True
+        
+    def build(self, ncldoc, rows):
+        # Adds everything to the document, which then holds all of it
+        for context, nodes, links in self.batches(rows):
+            parent = context if context != None else ncldoc
+            if context != None and context.parent == None:
+                ncldoc.add_node(context)
+            for node in nodes:
+                # A media spanning several batches is only added once
+                if node.parent == None:
+                    parent.add_node(node)
+            for link in links:
+                parent.add_link(link)
+        return ncldoc
+    
+    def batches(self, rows):
+        # Yields (context, nodes, links), context being None for the body.
+        # A context spanning several batches is the same object in each, and
+        # so is a media, which comes first in the next batch with the areas
+        # of the rows added since.
+        context = None
+        closed = set()
+        media = None
+        nodes = []
+        links = []
+        size = 0
+        for row in rows:
+            if not self.__checked:
+                self.check(row)
+            if self.context != None:
+                context_id = self.context['id'](row)
+                if context_id == None:
+                    raise ValueError('Row without a context id: ' + str(row))
+                if context == None or context.id != context_id:
+                    if len(nodes) > 0 or len(links) > 0:
+                        yield context, nodes, links
+                        nodes = []
+                        links = []
+                        size = 0
+                    if context_id in closed:
+                        raise ValueError('The rows of context %s are not consecutive' % context_id)
+                    if context != None:
+                        closed.add(context.id)
+                    context = Context(context_id)
+                    self.__resolve(context)
+                    media = None
+            
+            if size >= self.batch_size:
+                yield context, nodes, links
+                nodes = []
+                links = []
+                size = 0
+            size += 1
+            media_id = self.media['id'](row)
+            if media == None or media.id != media_id:
+                media = self.__media(row, media_id)
+                nodes.append(media)
+            elif len(nodes) == 0:
+                nodes.append(media)
+            if self.area != None:
+                area = self.__area(row)
+                if area != None:
+                    anchors = media.__dict__['_Node__anchors']
+                    if anchors == None:
+                        anchors = media.__dict__['_Node__anchors'] = []
+                    anchors.append(area)
+            if self.link != None:
+                link = self.__link(row)
+                if link != None:
+                    links.append(link)
+        if len(nodes) > 0 or len(links) > 0:
+            yield context, nodes, links
+        # The nodes no row made are left to IdRegistry.resolve
+        for binds in self.__pending.values():
+            for bind in binds:
+                self.registry.defer(bind, 'component', bind.component)
+        self.__pending = {}
+            
+    def release(self, nodes, links):
+        # Forgets written entities, so that the registry does not grow. The
+        # anchors are dropped from their node too, a media that goes on in
+        # the next batch then only holds the areas still to be written.
+        references = self.registry.references
+        for node in nodes:
+            self.registry.unregister(node)
+            self.__released.add(node.id)
+            for anchor in node.get_anchors():
+                self.registry.unregister(anchor)
+            node.__dict__['_Node__anchors'] = None
+        for link in links:
+            for bind in link.get_binds():
+                references.discard_all(bind)
+            if link.id != None:
+                self.registry.unregister(link)
+    
+    def __entity(self, cls, mid):
+        entity = object.__new__(cls)
+        object.__setattr__(entity, 'id', mid)
+        object.__setattr__(entity, 'missing_id', None)
+        object.__setattr__(entity, 'registry', self.registry)
+        if mid != None:
+            self.registry.register(entity)
+        return entity
+    
+    def __media(self, row, media_id):
+        if media_id == None:
+            raise ValueError('Row without a media id: ' + str(row))
+        if media_id in self.__released:
+            raise ValueError('The rows of media %s are not consecutive' % media_id)
+        media = self.__entity(Media, media_id)
+        mapping = self.media
+        descriptor = self.__descriptor(mapping['descriptor'](row)) if 'descriptor' in mapping \
+                     else None
+        media.__dict__.update({'_Node__anchors': None, 'refer': None, 'instance': None,
+                               'src': mapping['src'](row) if 'src' in mapping else None, 
+                               'type': mapping['type'](row) if 'type' in mapping else None, 
+                               'descriptor': descriptor})
+        self.registry.references.add(media, descriptor)
+        self.__resolve(media)
+        return media
+    
+    def __area(self, row):
+        area_id = self.area['id'](row) if 'id' in self.area else None
+        if area_id == None:
+            return None
+        area = self.__entity(Area, area_id)
+        for name in Area.__slots__:
+            value = self.area[name](row) if name in self.area else None
+            if value != None and name in self.TIMES and self.NUMBER.fullmatch(value) != None:
+                value = value + 's'
+            object.__setattr__(area, name, value)
+        return area
+    
+    def __link(self, row):
+        xconnector = self.link['xconnector'](row)
+        if xconnector == None:
+            return None
+        link = self.__entity(Link, self.link['id'](row) if 'id' in self.link else None)
+        object.__setattr__(link, 'missing_id', link.id == None)
+        references = self.registry.references
+        binds = []
+        for mapping in self.binds:
+            bind = object.__new__(Bind)
+            descriptor = self.__descriptor(mapping['descriptor'](row)) if 'descriptor' in mapping \
+                         else None
+            bind.__dict__.update({'registry': self.registry, 'link': link, 
+                                  'role': mapping['role'](row), 
+                                  'component': self.__component(bind, mapping['component'](row)),
+                                  'interface': mapping['interface'](row) 
+                                               if 'interface' in mapping else None,
+                                  'descriptor': descriptor, 
+                                  '_Bind__params': self.__params(mapping.get('params', {}), 
+                                                                 row)})
+            for name in Bind.REFERENCES:
+                references.add(bind, bind.__dict__[name])
+            binds.append(bind)
+        link.__dict__.update({'_Link__use_alias': '#' in xconnector, 
+                              '_Link__xconnector': self.__connector(xconnector),
+                              '_Link__binds': binds, 
+                              '_Link__params': self.__params(self.link_params, row)})
+        return link
+    
+    def __params(self, params, row):
+        values = {}
+        for name, value in params.items():
+            value = value(row)
+            if value != None:
+                values[name] = value
+        return values
+    
+    def __component(self, bind, mid):
+        # The node when it is registered, else a placeholder with its id,
+        # which serializes the same. Unless the node was already released,
+        # the bind waits for it in __pending, for the rows still to come.
+        node = self.registry.get(mid)
+        if isinstance(node, Node):
+            return node
+        if mid != None and mid not in self.__released:
+            self.__pending.setdefault(mid, []).append(bind)
+        return UnresolvedReference(mid, Node)
+    
+    def __resolve(self, node):
+        # Gives the binds waiting for node their component. The reference
+        # index only depends on the id, so it is left as it is.
+        for bind in self.__pending.pop(node.id, ()):
+            bind.__dict__['component'] = node
+    
+    def __connector(self, xconnector):
+        if '#' in xconnector:
+            return xconnector
+        connector = self.__connectors.get(xconnector)
+        if connector == None:
+            connector = self.registry.get(xconnector)
+            if not isinstance(connector, Connector):
+                raise ValueError('No connector with this id: ' + xconnector)
+            self.__connectors[xconnector] = connector
+        return connector
+    
+    def __descriptor(self, mid):
+        if mid == None:
+            return None
+        descriptor = self.__descriptors.get(mid)
+        if descriptor == None:
+            descriptor = self.registry.get(mid)
+            if not isinstance(descriptor, Descriptor):
+                raise ValueError('No descriptor with this id: ' + mid)
+            self.__descriptors[mid] = descriptor
+        return descriptor
+    
+class NclLoader:
+    # Rebuilds the object model from NCL markup. Entities are created as
+    # their start tags are read. Ports and links wait for the end of their
+    # context, since they may point at nodes declared after them, and refer
+    # attributes wait for the end of the document. In streaming mode every
+    # consumed element is cleared right away, so memory stays bounded by the
+    # model itself instead of the model plus the parsed tree.
+    #
+    # Only the elements the model has classes for are read: the region,
+    # descriptor and connector bases with their importBase, region,
+    # descriptor(Param) and causalConnector children, and body, context,
+    # media, area, property, port, link, linkParam, bind and bindParam.
+    # Any other element, like switch, meta, metadata, transitionBase or
+    # ruleBase, is dropped with its subtree: with strict that is a
+    # ValueError, otherwise a warning naming the element.
+    REGION_ATTRIBUTES = ('width', 'height', 'top', 'left', 'right', 'bottom',
+                         'zIndex', 'title')
+    DESCRIPTOR_ATTRIBUTES = ('player', 'explicitDur', 'region', 'moveLeft',
+                             'moveRight', 'moveUp', 'moveDown', 'focusIndex',
+                             'focusBorderColor', 'focusBorderWidth',
+                             'focusBorderTransparency', 'focusSrc',
+                             'focusSelSrc', 'selBorderColor')
+    AREA_ATTRIBUTES = ('coords', 'begin', 'end', 'beginText', 'endText',
+                       'beginPosition', 'endPosition', 'first', 'last',
+                       'label', 'clip')
+    BASES = ('regionBase', 'descriptorBase', 'connectorBase')
+    # Children of a link are read from its subtree once the link ends
+    LINK_CHILDREN = ('linkParam', 'bind', 'bindParam')
+    # And so are those of a causalConnector
+    CONNECTOR_PARTS = {'simpleCondition': SimpleCondition, 
+                       'attributeAssessment': AttributeAssessment,
+                       'simpleAction': SimpleAction}
+    CONNECTOR_CHILDREN = ('connectorParam', 'simpleCondition', 'compoundCondition', 
+                          'assessmentStatement', 'attributeAssessment', 'valueAssessment',
+                          'compoundStatement', 'simpleAction', 'compoundAction')
+    
+    def __init__(self, registry=None, strict=False):
+        self.registry = registry
+        self.strict = strict
+        self.__start_handlers = {'ncl': self.__start_ncl,
+                                 'importBase': self.__start_import_base,
+                                 'region': self.__start_region,
+                                 'descriptor': self.__start_descriptor,
+                                 'descriptorParam': self.__start_descriptor_param,
+                                 'body': self.__start_context,
+                                 'context': self.__start_context,
+                                 'media': self.__start_media,
+                                 'area': self.__start_area,
+                                 'property': self.__start_property,
+                                 'port': self.__start_port}
+        self.__end_handlers = {'context': self.__end_context,
+                               'body': self.__end_context,
+                               'link': self.__end_link,
+                               'causalConnector': self.__end_connector,
+                               'ncl': self.__end_ncl}
+        
+    def load(self, source, streaming=False):
+        if ET == None:
+            raise ImportError('lxml is required to load NCL documents')
+        if streaming:
+            events = ET.iterparse(source, events=('start', 'end'))
+        else:
+            events = ET.iterwalk(ET.parse(source), events=('start', 'end'))
+            
+        registry = self.registry
+        if registry == None:
+            registry = current_registry()
+        
+        self.__document = None
+        self.__base = None
+        self.__last_descriptor = None
+        self.__parents = []
+        self.__pending = []
+        self.__refers = []
+        self.__skip = 0
+        with id_scope(registry):
+            for event, xml_element in events:
+                tag = ET.QName(xml_element).localname
+                if event == 'start':
+                    self.__start(tag, xml_element)
+                else:
+                    self.__end(tag, xml_element, streaming)
+        return self.__document
+    
+    def __start(self, tag, xml_element):
+        if self.__skip > 0 or (tag not in self.__start_handlers and 
+                               tag not in self.__end_handlers and 
+                               tag not in self.BASES and 
+                               tag not in self.LINK_CHILDREN and 
+                               tag != 'head'):
+            # Elements the model has no class for are skipped with their
+            # subtree; the parts of connectors are read once they end
+            if self.__skip == 0 and tag not in self.CONNECTOR_CHILDREN:
+                self.__drop(tag, xml_element)
+            self.__skip += 1
+            return
+        
+        if tag in self.BASES:
+            self.__base = tag
+            setattr(self.__document, tag[:-4] + '_base_id', xml_element.get('id'))
+        
+        parent = self.__parents[-1] if len(self.__parents) > 0 else None
+        handler = self.__start_handlers.get(tag)
+        if handler != None:
+            entity = handler(dict(xml_element.attrib), parent)
+        else:
+            entity = parent
+        self.__parents.append(entity)
+        
+    def __drop(self, tag, xml_element):
+        message = 'Element not supported by the loader, dropped: ' + tag
+        if xml_element.get('id') != None:
+            message += ' ' + xml_element.get('id')
+        if self.strict:
+            raise ValueError(message)
+        warnings.warn(message)
+        
+    def __end(self, tag, xml_element, streaming):
+        if self.__skip > 0:
+            self.__skip -= 1
+        else:
+            entity = self.__parents.pop()
+            handler = self.__end_handlers.get(tag)
+            if handler != None:
+                handler(xml_element, entity)
+            
+        if (streaming and tag not in self.LINK_CHILDREN and tag not in self.CONNECTOR_CHILDREN 
+                and tag != 'ncl'):
+            xml_element.clear()
+            while xml_element.getprevious() is not None:
+                del xml_element.getparent()[0]
+    
+    def __start_ncl(self, attrib, parent):
+        self.__document = NclDocument(attrib.get('id'), registry=current_registry())
+        return self.__document
+    
+    def __start_import_base(self, attrib, parent):
+        region = attrib.get('region')
+        if region != None:
+            region = NclEntity.IDS[region]
+        imported_base = ImportedBase(attrib.get('alias'), attrib.get('documentURI'), 
+                                     region, attrib.get('baseId'))
+        if self.__base == 'regionBase':
+            self.__document.add_imported_region_base(imported_base)
+        elif self.__base == 'descriptorBase':
+            self.__document.add_imported_descriptor_base(imported_base)
+        else:
+            self.__document.add_imported_connector_base(imported_base)
+        return imported_base
+        
+    def __start_region(self, attrib, parent):
+        region = Region(attrib.get('id'), **self.__pick(attrib, self.REGION_ATTRIBUTES))
+        if isinstance(parent, Region):
+            parent.add_region(region)
+        else:
+            self.__document.region_base.append(region)
+        return region
+    
+    def __start_descriptor(self, attrib, parent):
+        kwargs = self.__pick(attrib, self.DESCRIPTOR_ATTRIBUTES)
+        if 'freeze' in attrib:
+            kwargs['freeze'] = attrib['freeze'] == 'true'
+        descriptor = Descriptor(attrib.get('id'), **kwargs)
+        for name in ('transIn', 'transOut'):
+            for transition_id in attrib.get(name, '').split(';'):
+                transition = NclEntity.IDS.get(transition_id.strip())
+                if isinstance(transition, Transition):
+                    getattr(descriptor, 'add_' + name)(transition)
+        self.__document.descriptor_base.append(descriptor)
+        self.__last_descriptor = descriptor
+        return descriptor
+    
+    def __start_descriptor_param(self, attrib, parent):
+        # dump writes descriptorParam next to its descriptor, not inside it
+        descriptor = parent if isinstance(parent, Descriptor) else self.__last_descriptor
+        descriptor.add_param(attrib.get('name'), attrib.get('value'))
+        return descriptor
+    
+    def __start_context(self, attrib, parent):
+        if parent is self.__document:
+            self.__document.bodyid = attrib.get('id')
+            context = Context(self.__document.bodyid, True)
+            self.__document.body = context
+        else:
+            context = Context(attrib.get('id'))
+            parent.add_node(context)
+        self.__defer_refer(context, attrib)
+        self.__pending.append([])
+        return context
+    
+    def __start_media(self, attrib, parent):
+        media = Media(attrib.get('id'), src=attrib.get('src'), mtype=attrib.get('type'), 
+                      instance=attrib.get('instance'), descriptor=attrib.get('descriptor'))
+        self.__defer_refer(media, attrib)
+        parent.add_node(media)
+        return media
+    
+    def __start_area(self, attrib, parent):
+        area = Area(attrib.get('id'), **self.__pick(attrib, self.AREA_ATTRIBUTES))
+        parent.add_anchor(area)
+        return area
+    
+    def __start_property(self, attrib, parent):
+        externable = attrib.get('externable')
+        if externable != None:
+            externable = externable == 'true'
+        node_property = NodeProperty(attrib.get('name'), attrib.get('value'), externable)
+        if isinstance(parent, Context):
+            self.__pending[-1].append(node_property)
+        else:
+            parent.add_anchor(node_property)
+        return node_property
+    
+    def __start_port(self, attrib, parent):
+        self.__pending[-1].append(('port', attrib))
+        return parent
     
+    @staticmethod
+    def children(xml_element):
+        # Child elements, without the comments and processing instructions
+        return [xml_child for xml_child in xml_element if isinstance(xml_child.tag, str)]
+    
+    def __end_link(self, xml_element, parent):
+        params = []
+        binds = []
+        for xml_child in NclLoader.children(xml_element):
+            tag = ET.QName(xml_child).localname
+            if tag == 'linkParam':
+                params.append((xml_child.get('name'), xml_child.get('value')))
+            elif tag == 'bind':
+                bind_params = [(xml_param.get('name'), xml_param.get('value')) 
+                               for xml_param in NclLoader.children(xml_child) 
+                               if ET.QName(xml_param).localname == 'bindParam']
+                binds.append((dict(xml_child.attrib), bind_params))
+        self.__pending[-1].append(('link', dict(xml_element.attrib), params, binds))
+        
+    def __end_connector(self, xml_element, parent):
+        params = {}
+        parts = []
+        for xml_child in NclLoader.children(xml_element):
+            if ET.QName(xml_child).localname == 'connectorParam':
+                params[xml_child.get('name')] = xml_child.get('type')
+            else:
+                parts.append(self.connector_part(xml_child))
+        if len(parts) != 2:
+            raise ValueError('A causalConnector must have one condition and one action: ' + 
+                             str(xml_element.get('id')))
+        self.__document.connector_base.append(Connector(xml_element.get('id'), parts[0], 
+                                                        parts[1], params))
+        
+    @staticmethod
+    def connector_part(xml_element):
+        tag = ET.QName(xml_element).localname
+        attrib = dict(xml_element.attrib)
+        if tag in NclLoader.CONNECTOR_PARTS:
+            return NclLoader.CONNECTOR_PARTS[tag](**attrib)
+        if tag == 'valueAssessment':
+            return ValueAssessment(attrib.get('value'))
+        
+        children = [NclLoader.connector_part(xml_child) 
+                    for xml_child in NclLoader.children(xml_element)]
+        if tag == 'compoundCondition':
+            return CompoundCondition(attrib.get('operator'), children, attrib.get('delay'))
+        if tag == 'compoundAction':
+            return CompoundAction(attrib.get('operator'), children, attrib.get('delay'))
+        if tag == 'compoundStatement':
+            return CompoundStatement(attrib.get('operator'), children, attrib.get('isNegated'))
+        if tag == 'assessmentStatement':
+            return AssessmentStatement(attrib.get('comparator'), children[0], children[1])
+        raise ValueError('Unknown causalConnector element: ' + tag)
+    
+    def __end_context(self, xml_element, context):
+        for item in self.__pending.pop():
+            if isinstance(item, NodeProperty):
+                context.add_anchor(item)
+            elif item[0] == 'port':
+                attrib = item[1]
+                context.add_anchor(Port(attrib.get('id'), attrib.get('component'), 
+                                        attrib.get('interface')))
+            else:
+                attrib, params, binds = item[1:]
+                link = Link(attrib.get('xconnector'), attrib.get('id'))
+                for name, value in params:
+                    link.add_param(name, value)
+                for bind_attrib, bind_params in binds:
+                    bind = Bind(bind_attrib.get('role'), bind_attrib.get('component'), 
+                                bind_attrib.get('interface'), bind_attrib.get('descriptor'))
+                    for name, value in bind_params:
+                        bind.add_param(name, value)
+                    link.add_bind(bind)
+                context.add_link(link)
+                
+    def __end_ncl(self, xml_element, document):
+        for entity, refer in self.__refers:
+            entity.refer = NclEntity.IDS[refer]
             
+    def __defer_refer(self, entity, attrib):
+        if 'refer' in attrib:
+            self.__refers.append((entity, attrib['refer']))
+            
+    @staticmethod
+    def __pick(attrib, names):
+        return dict((name, attrib[name]) for name in names if name in attrib)
+            
+
+class ValidationError:
+    # One broken reference found by NclValidator. entity is the entity
+    # holding the reference, attribute its name and value the referred id.
+    def __init__(self, entity, attribute, value, message):
+        self.entity = entity
+        self.attribute = attribute
+        self.value = value
+        self.message = message
+        
+    def __str__(self):
+        entity_id = getattr(self.entity, 'id', None)
+        if entity_id == None:
+            entity_id = type(self.entity).__name__
+        return '%s.%s=%s: %s' % (entity_id, self.attribute, self.value, self.message)
+    
+    def __repr__(self):
+        return '<ValidationError %s>' % self
+    
+class NclValidator:
+    # Checks every region, descriptor, component, interface, refer and
+    # xconnector reference of a document. The bases and the body are walked
+    # once to index ids, aliases and node interfaces, then every reference
+    # is a dictionary lookup, so the cost is linear in the document size.
+    def __init__(self, ncldoc, base_dir=None, cache=None):
+        self.ncldoc = ncldoc
+        self.base_dir = base_dir
+        self.cache = cache
+        self.__errors = []
+        self.__regions = {}
+        self.__descriptors = {}
+        self.__connectors = {}
+        self.__aliases = {}
+        self.__connector_bases = {}
+        self.__nodes = {}
+        self.__interfaces = {}
+        
+    def errors(self):
+        self.__index()
+        self.__check_ids()
+        self.__check_descriptors()
+        self.__check_nodes()
+        return self.__errors
+    
+    def __check_ids(self):
+        # Every id written to the output must appear once, even when the
+        # same entity is reachable twice
+        seen = set()
+        for entity, mid in self.__written_ids():
+            if mid in seen:
+                self.__error(entity, 'id', mid, 'Duplicate id in the document')
+            seen.add(mid)
+            
+    def __written_ids(self):
+        pending = list(self.ncldoc.region_base)
+        while len(pending) > 0:
+            region = pending.pop()
+            yield region, region.id
+            pending.extend(region.regions)
+        for entity in self.ncldoc.descriptor_base + self.ncldoc.connector_base:
+            yield entity, entity.id
+        pending = [self.ncldoc.body] if self.ncldoc.body != None else []
+        while len(pending) > 0:
+            node = pending.pop()
+            if node.id != None:
+                yield node, node.id
+            for anchor in node.get_anchors():
+                if isinstance(anchor, AreaBlock):
+                    for mid in anchor.get_ids():
+                        yield anchor, mid
+                elif not isinstance(anchor, NodeProperty) and anchor.id != None:
+                    yield anchor, anchor.id
+            if isinstance(node, Context):
+                pending.extend(node.get_nodes())
+                for link in node.get_links():
+                    if not link.missing_id:
+                        yield link, link.id
+    
+    def __error(self, entity, attribute, value, message):
+        self.__errors.append(ValidationError(entity, attribute, value, message))
+        
+    def __index(self):
+        pending = list(self.ncldoc.region_base)
+        while len(pending) > 0:
+            region = pending.pop()
+            self.__regions[region.id] = region
+            pending.extend(region.regions)
+        for descriptor in self.ncldoc.descriptor_base:
+            self.__descriptors[descriptor.id] = descriptor
+        for connector in self.ncldoc.connector_base:
+            self.__connectors[connector.id] = connector
+        for imported_base in self.ncldoc.get_imported_bases():
+            if imported_base.base_type == ImportedBase.CONNECTOR_BASE:
+                self.__aliases[imported_base.alias] = imported_base
+        if self.ncldoc.body != None:
+            pending = [self.ncldoc.body]
+            while len(pending) > 0:
+                node = pending.pop()
+                self.__nodes[node.id] = node
+                if isinstance(node, Context):
+                    pending.extend(node.get_nodes())
+                    
+    def __check(self, entity, attribute, target, index, kind):
+        if target == None:
+            return False
+        if index.get(target.id) is not target:
+            self.__error(entity, attribute, target.id, 'No %s with this id in the document' % kind)
+            return False
+        return True
+    
+    def __check_descriptors(self):
+        for descriptor in self.__descriptors.values():
+            self.__check(descriptor, 'region', descriptor.region, self.__regions, 'region')
+            
+    def interfaces(self, node):
+        # Ids of the areas and ports and names of the properties of a node,
+        # including those of the node it refers to
+        interfaces = self.__interfaces.get(node)
+        if interfaces == None:
+            interfaces = self.__interfaces[node] = set()
+            for anchor in node.get_anchors():
+                if isinstance(anchor, NodeProperty):
+                    interfaces.add(anchor.name)
+                elif isinstance(anchor, AreaBlock):
+                    interfaces.update(anchor.get_ids())
+                else:
+                    interfaces.add(anchor.id)
+            if node.refer != None and node.refer is not node:
+                interfaces.update(self.interfaces(node.refer))
+        return interfaces
+    
+    def __check_interface(self, entity, node, interface):
+        if interface != None and interface not in self.interfaces(node):
+            self.__error(entity, 'interface', interface, 
+                         'No interface with this id in node ' + node.id)
+            
+    def __check_nodes(self):
+        for node in self.__nodes.values():
+            if isinstance(node, Media):
+                self.__check(node, 'descriptor', node.descriptor, self.__descriptors, 
+                             'descriptor')
+            self.__check(node, 'refer', node.refer, self.__nodes, 'node')
+            if isinstance(node, Context):
+                for anchor in node.get_anchors():
+                    if isinstance(anchor, Port):
+                        self.__check_port(node, anchor)
+                for link in node.get_links():
+                    self.__check_link(node, link)
+                    
+    def __imported_roles(self, link, xconnector, alias, connector_id):
+        connector_base = self.__connector_base(alias)
+        if connector_base == None:
+            return None
+        if connector_id not in connector_base:
+            self.__error(link, 'xconnector', xconnector, 
+                         'No connector with this id in ' + connector_base.path)
+            return None
+        return connector_base.get_roles(connector_id)
+                
+    def __check_port(self, context, port):
+        if not self.__check(port, 'component', port.component, self.__nodes, 'node'):
+            return
+        if port.component.parent is not context:
+            self.__error(port, 'component', port.component.id, 
+                         'The component is not a child of context ' + context.id)
+        elif port.interface != None:
+            self.__check_interface(port, port.component, port.interface.id)
+            
+    def __connector_base(self, alias):
+        # Loaded once per alias; None when the base cannot be read, which is
+        # reported on the importBase
+        if alias not in self.__connector_bases:
+            imported_base = self.__aliases[alias]
+            try:
+                connector_base = imported_base.load_connectors(self.base_dir, self.cache)
+            except (OSError, SyntaxError) as error:
+                connector_base = None
+                self.__error(imported_base, 'documentURI', imported_base.documentURI, 
+                             'The connector base could not be loaded: ' + str(error))
+            self.__connector_bases[alias] = connector_base
+        return self.__connector_bases[alias]
+    
+    def __check_link(self, context, link):
+        xconnector = link.xml_attrib()['xconnector']
+        roles = None
+        if xconnector.count('#'):
+            alias, connector_id = xconnector.split('#', 1)
+            if alias not in self.__aliases:
+                self.__error(link, 'xconnector', xconnector, 
+                             'No imported connector base with this alias')
+            elif self.base_dir != None:
+                roles = self.__imported_roles(link, xconnector, alias, connector_id)
+        elif xconnector not in self.__connectors:
+            self.__error(link, 'xconnector', xconnector, 'No connector with this id in the document')
+        else:
+            roles = self.__connectors[xconnector].get_roles()
+        for bind in link.get_binds():
+            if roles != None and bind.role not in roles:
+                self.__error(bind, 'role', bind.role, 'No role with this name in connector ' + 
+                             xconnector)
+            self.__check(bind, 'descriptor', bind.descriptor, self.__descriptors, 'descriptor')
+            if not self.__check(bind, 'component', bind.component, self.__nodes, 'node'):
+                continue
+            if bind.component is not context and bind.component.parent is not context:
+                self.__error(bind, 'component', bind.component.id, 
+                             'The component is neither context %s nor one of its children' 
+                             % context.id)
+            else:
+                self.__check_interface(bind, bind.component, bind.interface)
+    
+class NclDeduplicator:
+    # Merges regions and descriptors that only differ in their id. Entities
+    # are keyed by their attribute tuple, so each base is merged in one pass.
+    # Regions are merged among siblings only, top-down, the subregions of a
+    # duplicate moving to the survivor. References to the duplicates are
+    # found in the reverse reference index and pointed at the survivors.
+    def __init__(self, ncldoc):
+        self.ncldoc = ncldoc
+        self.__merged = {}
+        
+    def merge(self):
+        self.__merge_regions(self.ncldoc.region_base)
+        self.ncldoc.descriptor_base[:] = self.__merge(self.ncldoc.descriptor_base, 
+                                                      NclDeduplicator.descriptor_key)
+        return self.__merged
+    
+    @staticmethod
+    def region_key(region):
+        attrib = region.xml_attrib()
+        del attrib['id']
+        return tuple(sorted(attrib.items()))
+    
+    @staticmethod
+    def descriptor_key(descriptor):
+        attrib = descriptor.xml_attrib()
+        del attrib['id']
+        params = descriptor.get_params()
+        return (tuple(sorted(attrib.items())), 
+                tuple(sorted((name, str(value)) for name, value in params.items())))
+    
+    def __merge_regions(self, regions):
+        pending = [regions]
+        while len(pending) > 0:
+            regions = pending.pop()
+            regions[:] = self.__merge(regions, NclDeduplicator.region_key)
+            for region in regions:
+                pending.append(region.regions)
+                
+    def __merge(self, entities, key):
+        survivors = {}
+        for entity in entities:
+            survivor = survivors.setdefault(key(entity), entity)
+            if survivor is not entity:
+                self.__replace(entity, survivor)
+        return list(survivors.values())
+    
+    def __replace(self, duplicate, survivor):
+        registry = self.ncldoc.registry
+        for referrer in registry.references.referrers(duplicate):
+            for name in referrer.REFERENCES:
+                if ReferenceIndex.key(getattr(referrer, name, None)) == duplicate.id:
+                    setattr(referrer, name, survivor)
+        if isinstance(duplicate, Region):
+            for region in duplicate.regions:
+                survivor.add_region(region)
+        registry.unregister(duplicate)
+        self.__merged[duplicate.id] = survivor
+    
+class RegionLayout:
+    # Absolute rectangles (left, top, width, height) of the regions of a
+    # document, in pixels of a screen of the given size. Regions are placed
+    # inside their parent from left/right/width and top/bottom/height, as
+    # pixels ('10', '10px' or a number) or percentages of the parent.
+    # arrays() and check() do the same on NumPy arrays, one tree level at a
+    # time, and need NumPy.
+    SCREEN = (1920, 1080)
+    ATTRIBUTES = ('left', 'right', 'width', 'top', 'bottom', 'height')
+    TOLERANCE = 1e-6
+    
+    def __init__(self, ncldoc, screen=None):
+        self.ncldoc = ncldoc
+        self.screen = screen if screen != None else self.SCREEN
+        
+    @staticmethod
+    def parse_length(value):
+        # Returns (number, is_percentage)
+        if isinstance(value, str):
+            value = value.strip()
+            if value.endswith('%'):
+                return float(value[:-1]), True
+            if value.endswith('px'):
+                value = value[:-2]
+        return float(value), False
+    
+    @staticmethod
+    def length(value, size):
+        if value == None:
+            return None
+        value, percentage = RegionLayout.parse_length(value)
+        if percentage:
+            return value * size / 100
+        return value
+    
+    @staticmethod
+    def place(near, far, extent, size):
+        # Offset and extent along one axis inside a parent of that size
+        near = RegionLayout.length(near, size)
+        far = RegionLayout.length(far, size)
+        extent = RegionLayout.length(extent, size)
+        if near == None:
+            if far != None and extent != None:
+                near = size - far - extent
+            else:
+                near = 0.0
+        if extent == None:
+            extent = size - near - (far if far != None else 0.0)
+        return near, extent
+    
+    def rectangles(self):
+        rectangles = {}
+        pending = [(region, (0.0, 0.0, float(self.screen[0]), float(self.screen[1]))) 
+                   for region in self.ncldoc.region_base]
+        while len(pending) > 0:
+            region, parent = pending.pop()
+            left, width = RegionLayout.place(region.left, region.right, region.width, parent[2])
+            top, height = RegionLayout.place(region.top, region.bottom, region.height, parent[3])
+            rectangle = (parent[0] + left, parent[1] + top, width, height)
+            rectangles[region] = rectangle
+            pending.extend([(subregion, rectangle) for subregion in region.regions])
+        return rectangles
+    
+    def arrays(self):
+        # Returns the regions in document order and an n x 4 array of their
+        # absolute (left, top, width, height)
+        regions, parents, depths, sizes, layers = self.__flatten()
+        return regions, self.__resolve(regions, parents, depths)
+    
+    def check(self):
+        # Reports, as ValidationErrors, the regions reaching out of the screen
+        # and every pair of overlapping regions in the same zIndex (regions
+        # without a zIndex are one layer). A region never overlaps its own
+        # ancestors. Pairs are found through a uniform grid, so the cost
+        # grows with the number of regions and actual overlaps, not with
+        # the number of pairs.
+        if np is None:
+            raise ImportError('numpy is required to check the region layout')
+        regions, parents, depths, sizes, layers = self.__flatten()
+        errors = []
+        if len(regions) == 0:
+            return errors
+        bounds = self.__resolve(regions, parents, depths)
+        left = bounds[:, 0]
+        top = bounds[:, 1]
+        right = left + bounds[:, 2]
+        bottom = top + bounds[:, 3]
+        
+        outside = ((left < -self.TOLERANCE) | (top < -self.TOLERANCE) | 
+                   (right > self.screen[0] + self.TOLERANCE) | 
+                   (bottom > self.screen[1] + self.TOLERANCE))
+        for i in np.flatnonzero(outside):
+            errors.append(ValidationError(regions[i], 'bounds', tuple(bounds[i].tolist()), 
+                                          'Region lies outside the %dx%d screen' % tuple(self.screen)))
+        
+        for i, j in self.__overlaps(left, top, right, bottom, sizes, layers):
+            errors.append(ValidationError(regions[i], 'zIndex', regions[j].id, 
+                                          'Region overlaps another region in the same zIndex'))
+        return errors
+    
+    def __flatten(self):
+        # Walks the region tree in document order. A region at position i
+        # has its descendants at positions i + 1 to i + sizes[i] - 1.
+        regions = []
+        parents = []
+        depths = []
+        layers = []
+        layer_ids = {}
+        pending = [(region, -1, 0) for region in reversed(self.ncldoc.region_base)]
+        while len(pending) > 0:
+            region, parent, depth = pending.pop()
+            position = len(regions)
+            regions.append(region)
+            parents.append(parent)
+            depths.append(depth)
+            layer = str(region.zIndex) if region.zIndex != None else None
+            layers.append(layer_ids.setdefault(layer, len(layer_ids)))
+            pending.extend([(subregion, position, depth + 1) 
+                            for subregion in reversed(region.regions)])
+        sizes = [1] * len(regions)
+        for position in range(len(regions) - 1, 0, -1):
+            if parents[position] >= 0:
+                sizes[parents[position]] += sizes[position]
+        if np is None:
+            return regions, parents, depths, sizes, layers
+        return (regions, np.array(parents, dtype=np.int64), np.array(depths, dtype=np.int64), 
+                np.array(sizes, dtype=np.int64), np.array(layers, dtype=np.int64))
+    
+    def __resolve(self, regions, parents, depths):
+        if np is None:
+            raise ImportError('numpy is required to compute region layout arrays')
+        n = len(regions)
+        values = np.full((n, len(self.ATTRIBUTES)), np.nan)
+        percentages = np.zeros((n, len(self.ATTRIBUTES)), dtype=bool)
+        for i, region in enumerate(regions):
+            for k, name in enumerate(self.ATTRIBUTES):
+                value = getattr(region, name)
+                if value != None:
+                    values[i, k], percentages[i, k] = RegionLayout.parse_length(value)
+        
+        bounds = np.empty((n, 4))
+        for depth in range(int(depths.max()) + 1 if n > 0 else 0):
+            level = np.flatnonzero(depths == depth)
+            if depth == 0:
+                parent = np.tile([0.0, 0.0, float(self.screen[0]), float(self.screen[1])], 
+                                 (len(level), 1))
+            else:
+                parent = bounds[parents[level]]
+            left, width = RegionLayout.place_arrays(values[level, 0:3], percentages[level, 0:3], 
+                                                    parent[:, 2])
+            top, height = RegionLayout.place_arrays(values[level, 3:6], percentages[level, 3:6], 
+                                                    parent[:, 3])
+            bounds[level, 0] = parent[:, 0] + left
+            bounds[level, 1] = parent[:, 1] + top
+            bounds[level, 2] = width
+            bounds[level, 3] = height
+        return bounds
+    
+    @staticmethod
+    def place_arrays(values, percentages, size):
+        # place() over columns (near, far, extent), NaN meaning unset
+        values = np.where(percentages, values * size[:, None] / 100, values)
+        near, far, extent = values[:, 0], values[:, 1], values[:, 2]
+        has_far = ~np.isnan(far)
+        near = np.where(np.isnan(near), 
+                        np.where(has_far & ~np.isnan(extent), size - far - extent, 0.0), near)
+        extent = np.where(np.isnan(extent), size - near - np.where(has_far, far, 0.0), extent)
+        return near, extent
+    
+    def __overlaps(self, left, top, right, bottom, sizes, layers):
+        # Every rectangle goes into each grid cell it covers; the candidates
+        # are the pairs sharing a cell, and a pair is kept only in the cell
+        # holding the corner of its intersection, so it is reported once.
+        n = len(left)
+        width = right - left
+        height = bottom - top
+        cell = max(float(np.median(np.maximum(width, height))), 1.0)
+        x0 = np.floor(left / cell).astype(np.int64)
+        y0 = np.floor(top / cell).astype(np.int64)
+        x1 = np.maximum(np.ceil(right / cell).astype(np.int64) - 1, x0)
+        y1 = np.maximum(np.ceil(bottom / cell).astype(np.int64) - 1, y0)
+        columns = x1 - x0 + 1
+        counts = columns * (y1 - y0 + 1)
+        
+        items = np.repeat(np.arange(n), counts)
+        offsets = np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = x0[items] + offsets % columns[items]
+        cell_y = y0[items] + offsets // columns[items]
+        order = np.lexsort((items, cell_y, cell_x, layers[items]))
+        items = items[order]
+        cell_x = cell_x[order]
+        cell_y = cell_y[order]
+        keys = layers[items]
+        
+        # Group boundaries, then for each entry the pairs with the entries
+        # after it in its group
+        starts = np.flatnonzero(np.concatenate(([True], (keys[1:] != keys[:-1]) | 
+                                                (cell_x[1:] != cell_x[:-1]) | 
+                                                (cell_y[1:] != cell_y[:-1]))))
+        ends = np.append(starts[1:], len(items))
+        group_ends = np.repeat(ends, ends - starts)
+        following = group_ends - np.arange(len(items)) - 1
+        first = np.repeat(np.arange(len(items)), following)
+        second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(following) - following, 
+                                                               following)
+        i = items[first]
+        j = items[second]
+        keep = ((np.maximum(left[i], left[j]) < np.minimum(right[i], right[j]) - self.TOLERANCE) & 
+                (np.maximum(top[i], top[j]) < np.minimum(bottom[i], bottom[j]) - self.TOLERANCE) & 
+                (cell_x[first] == np.maximum(x0[i], x0[j])) & 
+                (cell_y[first] == np.maximum(y0[i], y0[j])) & 
+                (j >= i + sizes[i]))
+        return zip(i[keep].tolist(), j[keep].tolist())
+
+class FocusNavigator:
+    # Sets focusIndex and moveLeft/Right/Up/Down of focusable descriptors
+    # from the geometry of their regions. Each direction goes to the nearest
+    # target whose center lies on that side, by the distance along the
+    # direction plus twice the distance across it. Centers are bucketed in
+    # a uniform grid searched ring by ring, stopping once no farther ring
+    # can hold a nearer target, so evenly spread layouts only visit a few
+    # cells per search. Descriptors sharing a focusIndex are one target. By
+    # default the focusable descriptors are those with a focusIndex; others
+    # given explicitly get their id as focusIndex.
+    DIRECTIONS = (('moveLeft', -1, 0), ('moveRight', 1, 0), ('moveUp', 0, -1), 
+                  ('moveDown', 0, 1))
+    ACROSS_WEIGHT = 2
+    
+    def __init__(self, ncldoc, descriptors=None, screen=None):
+        self.ncldoc = ncldoc
+        if descriptors == None:
+            descriptors = [descriptor for descriptor in ncldoc.descriptor_base 
+                           if descriptor.focusIndex != None]
+        self.descriptors = descriptors
+        self.screen = screen
+        
+    def assign(self):
+        # Returns focusIndex to its (moveLeft, moveRight, moveUp, moveDown)
+        rectangles = RegionLayout(self.ncldoc, self.screen).rectangles()
+        targets = {}
+        for descriptor in self.descriptors:
+            if descriptor.focusIndex == None:
+                descriptor.focusIndex = descriptor.id
+            if descriptor.focusIndex not in targets and descriptor.region in rectangles:
+                left, top, width, height = rectangles[descriptor.region]
+                targets[descriptor.focusIndex] = (left + width / 2, top + height / 2)
+                
+        moves = self.__moves(targets)
+        for descriptor in self.descriptors:
+            if descriptor.focusIndex in moves:
+                (descriptor.moveLeft, descriptor.moveRight, 
+                 descriptor.moveUp, descriptor.moveDown) = moves[descriptor.focusIndex]
+        return moves
+    
+    def __moves(self, targets):
+        if len(targets) == 0:
+            return {}
+        xs = [x for x, y in targets.values()]
+        ys = [y for x, y in targets.values()]
+        min_x, min_y = min(xs), min(ys)
+        # About two targets per cell
+        cell = max((2 * (max(xs) - min_x + 1) * (max(ys) - min_y + 1) / len(targets)) ** 0.5,
+                   1.0)
+        grid = {}
+        for focus_index, (x, y) in targets.items():
+            key = (int((x - min_x) // cell), int((y - min_y) // cell))
+            grid.setdefault(key, []).append((focus_index, x, y))
+        size = (int((max(xs) - min_x) // cell) + 1, int((max(ys) - min_y) // cell) + 1)
+        # Farthest center in each direction: targets there have nothing to
+        # move to, which would otherwise take a search of the whole grid
+        limits = {(-1, 0): min_x, (1, 0): max(xs), (0, -1): min_y, (0, 1): max(ys)}
+        
+        moves = {}
+        for focus_index, (x, y) in targets.items():
+            cell_key = (int((x - min_x) // cell), int((y - min_y) // cell))
+            move = []
+            for name, dx, dy in self.DIRECTIONS:
+                if (x * dx + y * dy) >= limits[(dx, dy)] * (dx + dy):
+                    move.append(None)
+                else:
+                    move.append(self.__nearest(grid, cell, size, cell_key, focus_index, 
+                                               x, y, dx, dy))
+            moves[focus_index] = tuple(move)
+        return moves
+    
+    def __nearest(self, grid, cell, size, cell_key, focus_index, x, y, dx, dy):
+        best, best_cost = None, None
+        column, row = cell_key
+        rings = max(column, size[0] - 1 - column, row, size[1] - 1 - row)
+        for ring in range(rings + 1):
+            # Every point of this ring is at least (ring - 1) cells away, and
+            # the cost is never below that distance
+            if best_cost != None and best_cost <= (ring - 1) * cell:
+                break
+            for key in FocusNavigator.ring(cell_key, ring, dx, dy, size):
+                for other, other_x, other_y in grid.get(key, ()):
+                    along = (other_x - x) * dx + (other_y - y) * dy
+                    if along <= 0 or other == focus_index:
+                        continue
+                    across = abs((other_x - x) * dy) + abs((other_y - y) * dx)
+                    cost = along + self.ACROSS_WEIGHT * across
+                    if best_cost == None or (cost, other) < (best_cost, best):
+                        best, best_cost = other, cost
+        return best
+    
+    @staticmethod
+    def ring(cell_key, ring, dx, dy, size):
+        # Cells of the grid at Chebyshev distance ring, on the side of the
+        # direction
+        column, row = cell_key
+        if ring == 0:
+            return [cell_key]
+        low_column = max(column - ring if dx <= 0 else column, 0)
+        high_column = min(column + ring if dx >= 0 else column, size[0] - 1)
+        low_row = max(row - ring if dy <= 0 else row, 0)
+        high_row = min(row + ring if dy >= 0 else row, size[1] - 1)
+        cells = []
+        for r in (row - ring, row + ring):
+            if low_row <= r <= high_row:
+                cells.extend([(c, r) for c in range(low_column, high_column + 1)])
+        for c in (column - ring, column + ring):
+            if low_column <= c <= high_column:
+                cells.extend([(c, r) for r in range(max(low_row, row - ring + 1), 
+                                                    min(high_row, row + ring - 1) + 1)])
+        return cells
+
+class IntervalIndex:
+    # Static index of half-open [begin, end) intervals for stabbing queries.
+    # Intervals are sorted by begin and a max tree is kept over their ends:
+    # the intervals begun by t are a prefix found by bisection, and subtrees
+    # whose greatest end is not after t are pruned, so a query costs
+    # O(log n) plus O(log n) per interval found. end None is open.
+    def __init__(self, intervals):
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.__begins = [begin for begin, end, item in intervals]
+        self.__items = [item for begin, end, item in intervals]
+        ends = [end if end != None else float('inf') for begin, end, item in intervals]
+        size = 1
+        while size < len(ends):
+            size *= 2
+        self.__size = size
+        self.__max_ends = [float('-inf')] * (2 * size)
+        self.__max_ends[size:size + len(ends)] = ends
+        for index in range(size - 1, 0, -1):
+            self.__max_ends[index] = max(self.__max_ends[2 * index], 
+                                         self.__max_ends[2 * index + 1])
+            
+    def __len__(self):
+        return len(self.__items)
+    
+    def active_at(self, t):
+        limit = bisect_right(self.__begins, t)
+        max_ends = self.__max_ends
+        size = self.__size
+        found = []
+        pending = [(1, 0, size)]
+        while len(pending) > 0:
+            index, low, high = pending.pop()
+            if low >= limit or max_ends[index] <= t:
+                continue
+            if index >= size:
+                found.append(low)
+                continue
+            middle = (low + high) // 2
+            pending.append((2 * index + 1, middle, high))
+            pending.append((2 * index, low, middle))
+        return [self.__items[position] for position in found]
+
+class Timeline:
+    # Presentation intervals, in seconds from the start of the document,
+    # of the nodes and areas scheduled by NclScheduler, by id. end is the
+    # end of the body, None when it is open.
+    def __init__(self, intervals, end=None):
+        self.intervals = intervals
+        self.end = end
+        self.__index = IntervalIndex([(begin, end, mid) 
+                                      for mid, (begin, end) in intervals.items()])
+        
+    def get(self, mid, default=None):
+        return self.intervals.get(mid, default)
+    
+    def __getitem__(self, mid):
+        return self.intervals[mid]
+    
+    def __contains__(self, mid):
+        return mid in self.intervals
+    
+    def __len__(self):
+        return len(self.intervals)
+    
+    def active_at(self, t):
+        return self.__index.active_at(t)
+
+class NclScheduler:
+    # Computes when the nodes and areas of a document are presented. The
+    # body starts at 0 and starts the components of its ports, contexts do
+    # the same when they start, and links fire on the onBegin and onEnd of
+    # their binds to start, stop or abort other nodes. Events are handled
+    # in time order, like Dijkstra's shortest paths, so every node gets its
+    # earliest start; restarts are not followed. Media last the explicitDur
+    # of their descriptor, or until stopped; a context without a stop ends
+    # with the last of its children. Links with other conditions, such as
+    # onSelection, need user input and are not scheduled, assessments are
+    # taken as true and the conditions of a link as alternatives.
+    TIMED_CONDITIONS = ('onBegin', 'onEnd')
+    START_ACTIONS = ('start',)
+    STOP_ACTIONS = ('stop', 'abort')
+    BEGIN = 0
+    END = 1
+    FIRE = 2
+    
+    def __init__(self, ncldoc):
+        self.ncldoc = ncldoc
+        self.__starts = {}
+        self.__stops = {}
+        self.__fired = set()
+        self.__triggers = {}
+        self.__delays = {}
+        self.__events = []
+        self.__sequence = count()
+        
+    def timeline(self):
+        if self.ncldoc.body == None:
+            return Timeline({}, 0.0)
+        self.__index_links()
+        self.__push(0.0, self.BEGIN, self.ncldoc.body)
+        while len(self.__events) > 0:
+            t, sequence, kind, target = heappop(self.__events)
+            if kind == self.BEGIN:
+                self.__begin(t, target)
+            elif kind == self.END:
+                self.__end(t, target)
+            else:
+                self.__fire(t, *target)
+        intervals = self.__intervals()
+        # The body may have no id
+        end = intervals.pop(self.ncldoc.body.id, (0.0, None))[1]
+        if self.ncldoc.body.id != None:
+            intervals[self.ncldoc.body.id] = (0.0, end)
+        return Timeline(intervals, end)
+    
+    def __push(self, t, kind, target):
+        heappush(self.__events, (t, next(self.__sequence), kind, target))
+        
+    def __index_links(self):
+        # (component, role) to the (interface, link) pairs it triggers
+        pending = [self.ncldoc.body]
+        while len(pending) > 0:
+            context = pending.pop()
+            for node in context.get_nodes():
+                if isinstance(node, Context):
+                    pending.append(node)
+            for link in context.get_links():
+                roles = [bind.role for bind in link.get_binds()]
+                if not all([role in self.TIMED_CONDITIONS for role in roles 
+                            if self.__is_condition(link, role)]):
+                    continue
+                for bind in link.get_binds():
+                    if bind.role in self.TIMED_CONDITIONS:
+                        self.__triggers.setdefault((bind.component, bind.role), []).append(
+                            (bind.interface, link, bind))
+                        
+    def __is_condition(self, link, role):
+        connector = link.get_xconnector()
+        if isinstance(connector, Connector):
+            return role in connector.get_condition().roles
+        # Imported connectors: conditions use the reserved on* role names
+        return role.startswith('on')
+    
+    def __delay(self, link, bind):
+        # The delay of the condition or action part of the bind role, with
+        # $name values taken from the bind and link params
+        connector = link.get_xconnector()
+        if not isinstance(connector, Connector):
+            return 0.0
+        delays = self.__delays.get(connector)
+        if delays == None:
+            delays = self.__delays[connector] = {}
+            pending = [(connector.get_condition(), None), (connector.get_action(), None)]
+            while len(pending) > 0:
+                part, delay = pending.pop()
+                delay = part.attrib.get('delay', delay)
+                if 'role' in part.attrib and delay != None:
+                    delays[part.attrib['role']] = delay
+                pending.extend([(child, delay) for child in part.children])
+        delay = delays.get(bind.role)
+        if delay != None and delay.startswith('$'):
+            delay = bind.get_params().get(delay[1:], link.get_params().get(delay[1:]))
+        delay = Area.parse_time(delay)
+        return delay if delay != None else 0.0
+    
+    @staticmethod
+    def areas(node):
+        # (id, begin, end) of the temporal areas of a node, in seconds
+        for anchor in node.get_anchors():
+            if isinstance(anchor, AreaBlock):
+                for mid, begin, end in anchor:
+                    yield mid, Area.parse_time(begin), Area.parse_time(end)
+            elif isinstance(anchor, Area) and anchor.begin != None:
+                yield anchor.id, Area.parse_time(anchor.begin), Area.parse_time(anchor.end)
+                
+    def __begin(self, t, node):
+        if node in self.__starts or (node.parent != None and node.parent not in self.__starts):
+            return
+        self.__starts[node] = t
+        if isinstance(node, Context):
+            for anchor in node.get_anchors():
+                if isinstance(anchor, Port):
+                    self.__push(t, self.BEGIN, anchor.component)
+        elif node.descriptor != None:
+            duration = Area.parse_time(node.descriptor.explicitDur)
+            if duration != None:
+                self.__push(t + duration, self.END, node)
+                
+        areas = self.__bound_areas(node)
+        for interface, link, bind in self.__triggers.get((node, 'onBegin'), []):
+            begin = areas[interface][0] if interface in areas else 0.0
+            if begin != None:
+                self.__fire_at(t + begin, link, bind, node)
+        for interface, link, bind in self.__triggers.get((node, 'onEnd'), []):
+            if interface in areas and areas[interface][1] != None:
+                self.__fire_at(t + areas[interface][1], link, bind, node)
+                
+    def __bound_areas(self, node):
+        # Begin and end of the areas of the node that links are bound to
+        interfaces = set([interface for role in self.TIMED_CONDITIONS 
+                          for interface, link, bind in self.__triggers.get((node, role), [])
+                          if interface != None])
+        if len(interfaces) == 0:
+            return {}
+        return dict((mid, (begin, end)) for mid, begin, end in NclScheduler.areas(node) 
+                    if mid in interfaces)
+    
+    def __fire_at(self, t, link, bind, node):
+        self.__push(t + self.__delay(link, bind), self.FIRE, (link, node, t))
+        
+    def __end(self, t, node):
+        if node not in self.__starts or node in self.__stops:
+            return
+        self.__stops[node] = t
+        if isinstance(node, Context):
+            for child in node.get_nodes():
+                self.__push(t, self.END, child)
+        # Areas without an end end with their node
+        areas = self.__bound_areas(node)
+        for interface, link, bind in self.__triggers.get((node, 'onEnd'), []):
+            if interface not in areas or areas[interface][1] == None:
+                self.__fire_at(t, link, bind, node)
+                
+    def __fire(self, t, link, node, event_time):
+        # Area events after the end of their node do not happen
+        if link in self.__fired or (node in self.__stops and self.__stops[node] < event_time):
+            return
+        self.__fired.add(link)
+        for bind in link.get_binds():
+            if bind.role in self.START_ACTIONS:
+                self.__push(t + self.__delay(link, bind), self.BEGIN, bind.component)
+            elif bind.role in self.STOP_ACTIONS:
+                self.__push(t + self.__delay(link, bind), self.END, bind.component)
+                
+    def __intervals(self):
+        intervals = {}
+        self.__context_end(self.ncldoc.body, intervals)
+        for node, start in self.__starts.items():
+            if isinstance(node, Media):
+                end = self.__stops.get(node)
+                for mid, begin, area_end in NclScheduler.areas(node):
+                    if begin == None or (end != None and start + begin >= end):
+                        continue
+                    area_end = start + area_end if area_end != None else end
+                    if end != None and area_end != None:
+                        area_end = min(area_end, end)
+                    intervals[mid] = (start + begin, area_end)
+                intervals[node.id] = (start, end)
+        return intervals
+    
+    def __context_end(self, context, intervals):
+        # Contexts are resolved bottom-up, as their end can come from their
+        # children
+        ends = []
+        for node in context.get_nodes():
+            if isinstance(node, Context):
+                end = self.__context_end(node, intervals)
+            else:
+                end = self.__stops.get(node)
+            if node in self.__starts:
+                ends.append(end)
+        if context not in self.__starts:
+            return None
+        end = self.__stops.get(context)
+        if end == None and len(ends) > 0 and None not in ends:
+            end = max(ends)
+        intervals[context.id] = (self.__starts[context], end)
+        return end
+    
+class EditingCommand:
+    # One NCL editing command. args are the command parameters after baseId
+    # and documentId; xml is the serialized entity for the add commands.
+    def __init__(self, name, base_id, document_id, args, xml=None):
+        self.name = name
+        self.base_id = base_id
+        self.document_id = document_id
+        self.args = args
+        self.xml = xml
+        
+    def __str__(self):
+        params = [self.base_id, self.document_id] + list(self.args)
+        params = [str(param) for param in params]
+        if self.xml != None:
+            params.append(self.xml.decode('utf-8'))
+        return '%s(%s)' % (self.name, ', '.join(params))
+    
+    def __repr__(self):
+        return '<EditingCommand %s>' % self
+    
+class NclDiff:
+    # Computes the editing commands that turn the old document into the new
+    # one. Entities are matched by id (properties by name) through
+    # dictionaries built per base and per context, so the cost is linear in
+    # the size of both documents. A node whose own attributes changed is
+    # removed and added again with its whole subtree; otherwise only its
+    # changed interfaces, children and links are sent.
+    REMOVE_ORDER = ('removeLink', 'removeInterface', 'removeNode', 'removeDescriptor', 
+                    'removeRegion', 'removeImportBase')
+    ADD_ORDER = ('addImportBase', 'addRegion', 'addDescriptor', 'addNode', 
+                 'addInterface', 'addLink')
+    # The base element holding each type of importBase
+    IMPORTING_BASES = {ImportedBase.REGION_BASE: 'region', 
+                       ImportedBase.DESCRIPTOR_BASE: 'descriptor', 
+                       ImportedBase.CONNECTOR_BASE: 'connector'}
+    
+    def __init__(self, old, new, base_id=None):
+        if ET == None:
+            raise ImportError('lxml is required to compare NCL documents')
+        self.old = old
+        self.new = new
+        self.base_id = base_id if base_id != None else new.id
+        self.__commands = dict((name, []) for name in self.REMOVE_ORDER + self.ADD_ORDER)
+        
+    def commands(self):
+        self.__diff_imported_bases()
+        self.__diff_regions()
+        self.__diff_descriptors()
+        self.__diff_body()
+        result = []
+        for name in self.REMOVE_ORDER + self.ADD_ORDER:
+            result.extend(self.__commands[name])
+        return result
+    
+    def __emit(self, name, args, xml=None):
+        self.__commands[name].append(EditingCommand(name, self.base_id, self.new.id, 
+                                                    args, xml))
+        
+    def __base_id(self, base):
+        # Id of the regionBase, descriptorBase or connectorBase the commands
+        # on its children refer to, see NclDocument.region_base_id
+        base_id = getattr(self.new, base + '_base_id')
+        if base_id == None:
+            base_id = getattr(self.old, base + '_base_id')
+        if base_id == None:
+            raise ValueError('The %sBase needs an id for its editing commands, ' % base + 
+                             'set NclDocument.%s_base_id' % base)
+        return base_id
+        
+    @staticmethod
+    def xml(entity):
+        xml_scratch = ET.Element('scratch')
+        entity.to_xml(xml_scratch)
+        return b''.join([ET.tostring(xml_element) for xml_element in xml_scratch])
+    
+    def __diff_imported_bases(self):
+        old = dict(((base.base_type, base.alias), base) for base in self.old.get_imported_bases())
+        new = dict(((base.base_type, base.alias), base) for base in self.new.get_imported_bases())
+        for key, base in old.items():
+            if key not in new or self.xml(new[key]) != self.xml(base):
+                self.__emit('removeImportBase', 
+                            [self.__base_id(self.IMPORTING_BASES[base.base_type]), 
+                             base.documentURI])
+        for key, base in new.items():
+            if key not in old or self.xml(old[key]) != self.xml(base):
+                self.__emit('addImportBase', 
+                            [self.__base_id(self.IMPORTING_BASES[base.base_type])], 
+                            self.xml(base))
+                
+    @staticmethod
+    def __flatten_regions(document):
+        # Parents always come before their subregions
+        regions = [(None, region) for region in document.region_base]
+        index = 0
+        while index < len(regions):
+            region = regions[index][1]
+            regions.extend([(region.id, subregion) for subregion in region.regions])
+            index += 1
+        return regions
+    
+    def __diff_regions(self):
+        old = self.__flatten_regions(self.old)
+        new = self.__flatten_regions(self.new)
+        old_index = dict((region.id, (parent, region)) for parent, region in old)
+        new_index = dict((region.id, (parent, region)) for parent, region in new)
+        
+        # A region goes and comes back with all its subregions, so only the
+        # topmost region of a changed subtree gets a command
+        changed = set()
+        for parent, region in old:
+            other = new_index.get(region.id)
+            if other == None or other[0] != parent or \
+                    other[1].xml_attrib() != region.xml_attrib():
+                changed.add(region.id)
+                
+        removed = set()
+        for parent, region in old:
+            if parent in removed or region.id in changed:
+                removed.add(region.id)
+                if parent not in removed:
+                    self.__emit('removeRegion', [self.__base_id('region'), region.id])
+                    
+        # Top level regions have no parent region to name
+        added = set()
+        for parent, region in new:
+            if parent in added or region.id not in old_index or region.id in changed:
+                added.add(region.id)
+                if parent not in added:
+                    args = [self.__base_id('region')]
+                    if parent != None:
+                        args.append(parent)
+                    self.__emit('addRegion', args, self.xml(region))
+            
+    def __diff_descriptors(self):
+        old = dict((descriptor.id, descriptor) for descriptor in self.old.descriptor_base)
+        new = dict((descriptor.id, descriptor) for descriptor in self.new.descriptor_base)
+        for mid, descriptor in old.items():
+            if mid not in new or self.xml(new[mid]) != self.xml(descriptor):
+                self.__emit('removeDescriptor', [self.__base_id('descriptor'), mid])
+        for mid, descriptor in new.items():
+            if mid not in old or self.xml(old[mid]) != self.xml(descriptor):
+                self.__emit('addDescriptor', [self.__base_id('descriptor')], 
+                            self.xml(descriptor))
+    
+    def __diff_body(self):
+        old, new = self.old.body, self.new.body
+        if old == None and new == None:
+            return
+        if old == None or new == None or old.xml_tag_attrib() != new.xml_tag_attrib():
+            # The body itself can not be edited, send everything under it
+            old_nodes = old.get_nodes() if old != None else []
+            new_nodes = new.get_nodes() if new != None else []
+            composite_id = self.__composite_id(new if new != None else old)
+            for node in old_nodes:
+                self.__emit('removeNode', [composite_id, node.id])
+            for node in new_nodes:
+                self.__emit('addNode', [composite_id], self.xml(node))
+            return
+        self.__diff_node(old, new)
+        
+    def __composite_id(self, context):
+        if context.id == None:
+            return self.new.id
+        return context.id
+    
+    @staticmethod
+    def __own_attrib(node):
+        if isinstance(node, Context):
+            return node.xml_tag_attrib()
+        return node.xml_attrib()
+    
+    @staticmethod
+    def __interfaces(node):
+        interfaces = {}
+        for anchor in node.get_anchors():
+            xml_scratch = ET.Element('scratch')
+            anchor.to_xml(xml_scratch)
+            for xml_element in xml_scratch:
+                interface_id = xml_element.get('id')
+                if interface_id == None:
+                    interface_id = xml_element.get('name')
+                interfaces[interface_id] = ET.tostring(xml_element)
+        return interfaces
+    
+    def __diff_node(self, old, new, links=None):
+        old_interfaces = self.__interfaces(old)
+        new_interfaces = self.__interfaces(new)
+        node_id = self.__composite_id(new)
+        for interface_id, xml in old_interfaces.items():
+            if new_interfaces.get(interface_id) != xml:
+                self.__emit('removeInterface', [node_id, interface_id])
+        for interface_id, xml in new_interfaces.items():
+            if old_interfaces.get(interface_id) != xml:
+                self.__emit('addInterface', [node_id], xml)
+                
+        if isinstance(new, Context):
+            self.__diff_children(old, new)
+            if links == None:
+                links = self.__link_changes(old, new)
+            self.__diff_links(new, links)
+            
+    def __diff_children(self, old, new):
+        composite_id = self.__composite_id(new)
+        old_nodes = dict((node.id, node) for node in old.get_nodes())
+        new_nodes = dict((node.id, node) for node in new.get_nodes())
+        for mid, node in old_nodes.items():
+            other = new_nodes.get(mid)
+            if other == None or type(other) != type(node) or \
+                    self.__own_attrib(other) != self.__own_attrib(node):
+                self.__emit('removeNode', [composite_id, mid])
+        for mid, node in new_nodes.items():
+            other = old_nodes.get(mid)
+            if other == None or type(other) != type(node) or \
+                    self.__own_attrib(other) != self.__own_attrib(node):
+                self.__emit('addNode', [composite_id], self.xml(node))
+            elif isinstance(node, Context):
+                # A link without id can only go away with its context, so
+                # such a context is sent again as a whole
+                links = self.__link_changes(other, node)
+                if any([link.missing_id for link in links[0]]):
+                    self.__emit('removeNode', [composite_id, mid])
+                    self.__emit('addNode', [composite_id], self.xml(node))
+                else:
+                    self.__diff_node(other, node, links)
+            else:
+                self.__diff_node(other, node)
+                
+    def __link_key(self, link):
+        # Links without an id of their own are only known by their content
+        if link.missing_id:
+            return self.xml(link)
+        return link.id
+    
+    def __link_changes(self, old, new):
+        # The links of old to remove and those of new to add
+        old_links = dict((self.__link_key(link), link) for link in old.get_links())
+        new_links = dict((self.__link_key(link), link) for link in new.get_links())
+        removed = [link for key, link in old_links.items() 
+                   if key not in new_links or self.xml(new_links[key]) != self.xml(link)]
+        added = [link for key, link in new_links.items() 
+                 if key not in old_links or self.xml(old_links[key]) != self.xml(link)]
+        return removed, added
+    
+    def __diff_links(self, new, links):
+        composite_id = self.__composite_id(new)
+        removed, added = links
+        for link in removed:
+            if link.missing_id:
+                # Only left for the body, which can not be sent again
+                raise ValueError('A link without id in the body can not be removed by an ' + 
+                                 'editing command, give it an id: ' + 
+                                 self.xml(link).decode('utf-8'))
+            self.__emit('removeLink', [composite_id, link.id])
+        for link in added:
+            self.__emit('addLink', [composite_id], self.xml(link))
+            
+
+class BatchResult:
+    # Outcome of one job of build_documents. data holds the serialized
+    # document, or filename the file it was written to; when the builder or
+    # the serializer failed, error holds the formatted traceback instead.
+    def __init__(self, name, data=None, filename=None, error=None):
+        self.name = name
+        self.data = data
+        self.filename = filename
+        self.error = error
+        
+    def __repr__(self):
+        if self.error != None:
+            return '<BatchResult %s failed>' % self.name
+        return '<BatchResult %s ok>' % self.name
+
+def build_job(builder, name, params, output_dir=None, allocator=None):
+    # Runs in the worker processes. Every job gets a registry of its own, so
+    # jobs never see each other's ids.
+    try:
+        if isinstance(allocator, type) or (allocator != None and 
+                                           not hasattr(allocator, 'allocate')):
+            allocator = allocator(name)
+        with id_scope(IdRegistry(allocator)):
+            ncldoc = builder(**params)
+            if output_dir == None:
+                return BatchResult(name, data=ncldoc.dump(streaming=True))
+            filename = os.path.join(output_dir, name)
+            ncldoc.dump_file(filename, streaming=True)
+            return BatchResult(name, filename=filename)
+    except Exception:
+        return BatchResult(name, error=traceback.format_exc())
+
+def build_documents(builder, jobs, output_dir=None, max_workers=None, max_in_flight=None, 
+                    allocator=None):
+    # Builds and serializes one document per (name, params) job in a pool of
+    # processes, calling builder(**params) to get each NclDocument. Results
+    # are yielded as they complete. builder must be picklable, i.e. defined
+    # at module level. With output_dir the workers write output_dir/name
+    # themselves and only the file name comes back. At most max_in_flight
+    # jobs (twice the workers by default) are pending at any time, so the
+    # memory used does not grow with the number of jobs. allocator is used
+    # by the registry of every job; it can also be a picklable callable
+    # making one from the job name, SequentialIdAllocator for instance gives
+    # each job ids of its own. A job that can not be sent to or come back
+    # from a worker, like any other failing job, only gets an error result.
+    if max_workers == None:
+        max_workers = os.cpu_count() or 1
+    if max_in_flight == None:
+        max_in_flight = 2 * max_workers
+    with ProcessPoolExecutor(max_workers) as executor:
+        pending = {}
+        for name, params in jobs:
+            if len(pending) >= max_in_flight:
+                yield from _completed_jobs(pending)
+            try:
+                future = executor.submit(build_job, builder, name, params, output_dir, 
+                                         allocator)
+            except Exception:
+                yield BatchResult(name, error=traceback.format_exc())
+                continue
+            pending[future] = name
+        while len(pending) > 0:
+            yield from _completed_jobs(pending)
+            
+def _completed_jobs(pending):
+    # Waits for at least one of the pending futures and removes the done ones
+    done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+    for future in done:
+        name = pending.pop(future)
+        try:
+            yield future.result()
+        except Exception:
+            yield BatchResult(name, error=traceback.format_exc())
+
+class ProfileRecord:
+    # Calls of one method of one entity type in one phase. time includes
+    # the instrumented calls made from it (counted again for recursive
+    # calls), own_time and own_net_memory exclude them. net_memory is, with
+    # profile(memory=True), the net change of the memory traced by
+    # tracemalloc over the calls: bytes still held when they return, which
+    # is negative when they free more than they keep, not the bytes they
+    # allocated (CPython does not count those).
+    __slots__ = ('phase', 'entity', 'method', 'calls', 'time', 'own_time', 'net_memory', 
+                 'own_net_memory')
+    
+    def __init__(self, phase, entity, method):
+        self.phase = phase
+        self.entity = entity
+        self.method = method
+        self.calls = 0
+        self.time = 0.0
+        self.own_time = 0.0
+        self.net_memory = 0
+        self.own_net_memory = 0
+        
+    def __repr__(self):
+        return '<ProfileRecord %s %s.%s calls=%d own_time=%.6f>' % (self.phase, self.entity, 
+                                                                   self.method, self.calls, 
+                                                                   self.own_time)
+
+class ProfileReport:
+    # Filled by profile(). Methods that belong to no phase of their own,
+    # like xml_attrib or Area.format_time, are counted in the phase of
+    # their caller, so attribute formatting for the tree and for the
+    # streaming writers shows up apart. So are constructors, which only
+    # count as build when called outside any phase: XmlTextStream made by
+    # dump() is part of the write phase. The own time of to_xml is mostly
+    # lxml SubElement, that of dump and dump_file the final tostring or
+    # write.
+    PHASES = {'__init__': None, 'clone': 'build', 'load': 'build', 'batches': 'build',
+              'to_xml': 'tree', '_NclDocument__to_xml': 'tree', 
+              'write_xml': 'write', 'dump': 'write', 'dump_file': 'write', 'dump_rows': 'write', 
+              'flush': 'write', 'raw': 'write',
+              'xml_attrib': None, 'xml_tag_attrib': None, 'param_attrib': None, 
+              'format_time': None}
+    
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = {}
+        self.__stack = []
+        
+    def call(self, phase, entity, method, function, args, kwargs):
+        if phase == None:
+            phase = self.__stack[-1][0] if len(self.__stack) > 0 else 'build'
+        frame = [phase, 0.0, 0]
+        self.__stack.append(frame)
+        memory = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = perf_counter() - start
+            if self.memory:
+                memory = tracemalloc.get_traced_memory()[0] - memory
+            self.__stack.pop()
+            key = (phase, entity, method)
+            record = self.records.get(key)
+            if record == None:
+                record = self.records[key] = ProfileRecord(phase, entity, method)
+            record.calls += 1
+            record.time += elapsed
+            record.own_time += elapsed - frame[1]
+            record.net_memory += memory
+            record.own_net_memory += memory - frame[2]
+            if len(self.__stack) > 0:
+                self.__stack[-1][1] += elapsed
+                self.__stack[-1][2] += memory
+                
+    def rows(self):
+        # Records by decreasing own time
+        return sorted(self.records.values(), key=lambda record: -record.own_time)
+    
+    def phases(self):
+        return self.__totals('phase')
+    
+    def entities(self):
+        return self.__totals('entity')
+    
+    def __totals(self, attribute):
+        # Calls, own time and own net memory added up per phase or entity
+        totals = {}
+        for record in self.records.values():
+            key = getattr(record, attribute)
+            total = totals.get(key)
+            if total == None:
+                total = totals[key] = ProfileRecord(None, None, None)
+                setattr(total, attribute, key)
+            total.calls += record.calls
+            total.own_time += record.own_time
+            total.own_net_memory += record.own_net_memory
+        for total in totals.values():
+            total.time = total.own_time
+            total.net_memory = total.own_net_memory
+        return totals
+    
+    def __str__(self):
+        lines = ['%-6s %-20s %-24s %9s %10s %10s %14s' % ('phase', 'entity', 'method', 'calls', 
+                                                          'time', 'own_time', 'own_net_memory')]
+        for record in self.rows():
+            lines.append('%-6s %-20s %-24s %9d %10.6f %10.6f %14d' % 
+                         (record.phase, record.entity, record.method, record.calls, 
+                          record.time, record.own_time, record.own_net_memory))
+        return '\n'.join(lines)
+
+@contextmanager
+def profile(memory=False):
+    # Records, into the yielded ProfileReport, the calls of the constructors,
+    # to_xml, write_xml, xml_attrib and dump methods of every entity and of
+    # the serializers. The methods are only wrapped inside the with block
+    # and put back on exit, so there is no cost at all otherwise. Only
+    # profile one thread at a time. With memory, tracemalloc is started if
+    # needed and the net memory change of every call is recorded too.
+    global _PROFILE_ACTIVE
+    if _PROFILE_ACTIVE:
+        raise ValueError('A profile is already active')
+    report = ProfileReport(memory)
+    classes = [NclDocument, NclLoader, NclTableBuilder, XmlStream, XmlTextStream, 
+               ImportedBase, Region, Descriptor, Connector, Transition, Node, Context, Media, 
+               Anchor, Port, NodeProperty, Area, AreaBlock, Link, Bind]
+    classes.extend(ConnectorPart.__subclasses__() + [ConnectorPart])
+    originals = []
+    for cls in classes:
+        for method, phase in ProfileReport.PHASES.items():
+            original = cls.__dict__.get(method)
+            if original == None:
+                continue
+            originals.append((cls, method, original))
+            setattr(cls, method, _profiled(report, cls, method, phase, original))
+    
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _PROFILE_ACTIVE = True
+    try:
+        yield report
+    finally:
+        _PROFILE_ACTIVE = False
+        for cls, method, original in originals:
+            setattr(cls, method, original)
+        if started:
+            tracemalloc.stop()
+        
+_PROFILE_ACTIVE = False
+
+def _profiled(report, cls, method, phase, original):
+    if isinstance(original, staticmethod):
+        function = original.__func__
+        
+        def static_wrapper(*args, **kwargs):
+            return report.call(phase, cls.__name__, method, function, args, kwargs)
+        return staticmethod(static_wrapper)
+    
+    def wrapper(self, *args, **kwargs):
+        # Methods inherited, or called through super, are told apart
+        if type(self) is cls:
+            return report.call(phase, cls.__name__, method, original, (self,) + args, kwargs)
+        return report.call(phase, type(self).__name__, cls.__name__ + '.' + method, original, 
+                           (self,) + args, kwargs)
+    return wrapper
+
 
 def test():
     ncldoc = NclDocument('nclTest')